@@ -1,4 +1,16 @@
-import time, random, string
+import collections, itertools, socket, time, random, string
+
+import Capture, ISupport, Metrics
+
+# most platforms' IOV_MAX is 1024, sendmsg() fails with more buffers than that
+MAX_SEND_BUFFERS = 1024
+# how much read() asks recv_into() for, which doubles while reads fill it and
+# halves while they don't fill a quarter of it
+READ_SIZE_MIN = 2048
+READ_SIZE_MAX = 65536
+
+# fileno()s get reused, these don't
+CONNECTION_IDS = itertools.count(1)
 
 class Bot(object):
     def __init__(self, s, nickname, username, realname):
@@ -6,11 +18,34 @@ class Bot(object):
         self.username = username
         self.realname = realname
         self.socket = s
-        self.write_buffer = b""
-        self.read_buffer = b""
+        self.connection_id = next(CONNECTION_IDS)
+        # a Capture.CaptureWriter, set by BotManager.start_capture
+        self.capture = None
+        # called once something's queued to send, set by BotManager.add_bot
+        # so lines queued from other threads don't wait for epoll to time out
+        self.wake = None
+        # encoded lines waiting to be sent, the first of which has had
+        # _write_offset bytes of it sent already
+        self._write_queue = collections.deque()
+        self._write_offset = 0
+        self.queued_bytes = 0
+        # cleared if the socket turns out not to have sendmsg(), e.g. SSL
+        self._use_sendmsg = True
+        # received bytes are kept in _read_buffer[_read_start:_read_end], the
+        # part after _read_scan is yet to be searched for a line ending
+        self._read_buffer = bytearray(READ_SIZE_MIN*2)
+        self._read_start = self._read_end = self._read_scan = 0
+        self._read_size = READ_SIZE_MIN
+        # why the last read() returned None
+        self.read_error = None
         self.last_read = None
         self.ping_sent = False
-        self._channels = []
+        # time.monotonic() of the last PING we sent, until it's answered
+        self._ping_sent_at = None
+        self.metrics = Metrics.ConnectionMetrics()
+        self.isupport = ISupport.ISupport()
+        # case-folded name -> name
+        self._channels = {}
         self.last_status = 0
         self.prefix = "".join([random.choice(string.ascii_uppercase) for n in range(4)])
         self.use_prefix = True
@@ -19,42 +54,115 @@ class Bot(object):
         return self.socket.fileno()
 
     def queue_send(self, data):
-        encoded_data = data.encode("utf8")
+        if not self.capture == None:
+            self.capture.write(self.connection_id, Capture.OUTBOUND, data)
         if self.use_prefix:
-            self.write_buffer += ":{} ".format(self.prefix).encode("utf8")
-        self.write_buffer += encoded_data + b"\r\n"
+            data = ":{} {}\r\n".format(self.prefix, data)
+        else:
+            data += "\r\n"
+        encoded_data = data.encode("utf8")
+        self._write_queue.append(encoded_data)
+        self.queued_bytes += len(encoded_data)
+        self.metrics.lines_out += 1
+        if not self.wake == None:
+            self.wake()
 
     def send(self):
-        self.write_buffer = self.write_buffer[self.socket.send(self.write_buffer):]
+        # hands as much of the queue as we can to one sendmsg(), without
+        # joining it into one buffer. a partly sent line stays where it is,
+        # with a memoryview skipping what's been sent
+        if not self._write_queue:
+            return 0
+        first = self._write_queue[0]
+        if self._write_offset:
+            first = memoryview(first)[self._write_offset:]
+        sent = None
+        if self._use_sendmsg and len(self._write_queue) > 1:
+            buffers = [first]
+            for i in range(1, min(len(self._write_queue), MAX_SEND_BUFFERS)):
+                buffers.append(self._write_queue[i])
+            try:
+                sent = self.socket.sendmsg(buffers)
+            except (AttributeError, NotImplementedError):
+                self._use_sendmsg = False
+        if sent == None:
+            sent = self.socket.send(first)
+        self.queued_bytes -= sent
+        self.metrics.bytes_out += sent
+
+        offset = self._write_offset+sent
+        while self._write_queue and offset >= len(self._write_queue[0]):
+            offset -= len(self._write_queue.popleft())
+        self._write_offset = offset
+        return sent
 
     def waiting_send(self):
-        return bool(len(self.write_buffer))
+        return bool(self._write_queue)
+
+    def _recv_into(self, view):
+        try:
+            return self.socket.recv_into(view)
+        except AttributeError:
+            data = self.socket.recv(len(view))
+            view[:len(data)] = data
+            return len(data)
 
     def read(self):
-        data = b""
+        # returns the complete lines received, [] if there's nothing to read
+        # yet, or None if the connection is closed or broken
+        buffer = self._read_buffer
+        if self._read_start == self._read_end:
+            self._read_start = self._read_end = self._read_scan = 0
+        elif self._read_end+self._read_size > len(buffer):
+            # move the partial line at the end to the start
+            length = self._read_end-self._read_start
+            buffer[:length] = buffer[self._read_start:self._read_end]
+            self._read_scan -= self._read_start
+            self._read_start, self._read_end = 0, length
+        if self._read_end+self._read_size > len(buffer):
+            buffer.extend(bytes(self._read_end+self._read_size-len(buffer)))
+
         try:
-            data = self.read_buffer+self.socket.recv(2048)
-        except:
+            with memoryview(buffer) as view:
+                received = self._recv_into(view[self._read_end:
+                    self._read_end+self._read_size])
+        except (BlockingIOError, InterruptedError, socket.timeout):
             return []
-        self.read_buffer = b""
-        data_lines = [line.strip(b"\r") for line in data.split(b"\n")]
-
-        if data_lines[-1]:
-            self.read_buffer = data_lines[-1]
-        data_lines.pop(-1)
+        except Exception as e:
+            self.read_error = e
+            return None
+        if not received:
+            self.read_error = EOFError("connection closed")
+            return None
+
+        if received == self._read_size:
+            self._read_size = min(self._read_size*2, READ_SIZE_MAX)
+        elif received < self._read_size//4:
+            self._read_size = max(self._read_size//2, READ_SIZE_MIN)
+        self._read_end += received
+        self.metrics.bytes_in += received
+        self.metrics.read_bursts.observe(received)
+        self.last_read = time.time()
+        self.ping_sent = False
 
         decoded_lines = []
-        for line in data_lines:
-            try:
-                line = line.decode("utf8")
-            except:
+        start, end = self._read_start, self._read_end
+        with memoryview(buffer) as view:
+            newline = buffer.find(b"\n", self._read_scan, end)
+            while newline > -1:
+                stop = newline
+                if stop > start and buffer[stop-1] == 13: # \r
+                    stop -= 1
+                line = view[start:stop]
                 try:
-                    line = line.decode("latin-1")
-                except:
-                    continue
-            decoded_lines.append(line)
-        self.last_read = time.time()
-        self.ping_sent = False
+                    decoded_lines.append(str(line, "utf8"))
+                except UnicodeDecodeError:
+                    decoded_lines.append(str(line, "latin-1"))
+                start = newline+1
+                newline = buffer.find(b"\n", start, end)
+        self._read_start = start
+        self._read_scan = end
+        self.metrics.lines_in += len(decoded_lines)
         return decoded_lines
 
     def identify(self):
@@ -67,6 +175,14 @@ class Bot(object):
     def send_ping(self, text="hello"):
         self.queue_send("PING :{0}".format(text))
         self.ping_sent = True
+        self._ping_sent_at = time.monotonic()
+
+    def pong_received(self):
+        if not self._ping_sent_at == None:
+            rtt = time.monotonic()-self._ping_sent_at
+            self._ping_sent_at = None
+            self.metrics.last_ping_rtt = rtt
+            self.metrics.ping_rtt.observe(rtt)
 
     def send_pong(self, text):
         self.queue_send("PONG :{0}".format(text))
@@ -90,14 +206,16 @@ class Bot(object):
         self.queue_send("WHO {}".format(channel))
 
     def is_own_nickname(self, nickname):
-        return self.nickname==nickname
+        return bool(nickname) and self.isupport.equals(self.nickname, nickname)
 
     def add_channel(self, channel):
-        self._channels.append(channel)
+        self._channels[self.isupport.casefold(channel)] = channel
 
     def remove_channel(self, channel):
-        if channel in self._channels:
-            self._channels.remove(channel)
+        self._channels.pop(self.isupport.casefold(channel), None)
+
+    def in_channel(self, channel):
+        return self.isupport.casefold(channel) in self._channels
 
     def summary(self):
-        return "<{} ({}): {}>".format(self.nickname, self.last_status, ", ".join(self._channels))
+        return "<{} ({}): {}>".format(self.nickname, self.last_status, ", ".join(self._channels.values()))
@@ -0,0 +1,190 @@
+import asyncio, os, select, threading, time
+
+import Capture, Channels, EventManager, IRCLine, IRCLineHandler, Metrics
+from Logs import log_message
+
+class BotManager(object):
+    def __init__(self):
+        self.bots = {}
+        self.running = True
+        self.events = EventManager.EventHook(self)
+        # who's in the channels our bots are in, shared between them
+        self.channels = Channels.ChannelStore()
+        # coroutine callbacks run here rather than on the epoll thread
+        self.loop = asyncio.new_event_loop()
+        # for hook(..., executor=bot_manager.executor)
+        self.executor = EventManager.BoundedExecutor()
+
+        def set_status(event):
+            event["bot"].last_status = event["command"]
+        self.events.single("received/numeric").hook(set_status)
+
+        self.poll = select.epoll()
+        # a byte written here wakes run() out of poll(), see wake()
+        self._wake_read, self._wake_write = os.pipe()
+        os.set_blocking(self._wake_read, False)
+        os.set_blocking(self._wake_write, False)
+        self.poll.register(self._wake_read, select.EPOLLIN)
+        # true while run() is going to look at every write queue before it
+        # next polls, so there's no need to write to the pipe
+        self._awake = False
+        self._random_nicknames = []
+        # a Capture.CaptureWriter while start_capture is in effect
+        self.capture = None
+        # the totals of removed bots, so aggregate counters never go down
+        self.retired_metrics = Metrics.ConnectionMetrics()
+
+    def run(self):
+        while self.running:
+            # epoll's timeout is in seconds. wake() cuts it short when
+            # there's something to send
+            events = self.poll.poll(10)
+            self._awake = True
+            for fileno, event in events:
+                if fileno == self._wake_read:
+                    self._drain_wake()
+                    continue
+                bot = self.bots[fileno]
+                if event & select.EPOLLIN:
+                    lines = bot.read()
+                    if lines == None:
+                        log_message("bots", "Removing for read error: {}".format(
+                            bot.read_error))
+                        self.remove_bot(bot)
+                    else:
+                        for line in lines:
+                            # If this isn't None, the connection is effectively dead
+                            quit_status = self.parse_line(line, bot)
+                            if quit_status:
+                                log_message("bots", "Removing for END")
+                                self.remove_bot(bot)
+                                break
+
+                elif event & select.EPOLLOUT:
+                    bot.send()
+                    self.poll.modify(bot.fileno(),
+                        select.EPOLLIN)
+
+                elif event & select.EPOLLHUP:
+                    log_message("bots", "Removing for hangup")
+                    self.remove_bot(bot)
+
+            # anything queued from here on needs a wake()
+            self._awake = False
+            for bot in list(self.bots.values()):
+                since_last_read = (
+                    None if not bot.last_read else time.time(
+                    )-bot.last_read)
+                if since_last_read:
+                    if since_last_read > 120:
+                        log_message("bots", "Removing for presumed timeout")
+                        self.remove_bot(bot)
+                        continue
+                    elif since_last_read > 30 and not bot.ping_sent:
+                        bot.send_ping()
+                if bot.waiting_send():
+                    self.poll.modify(bot.fileno(),
+                        select.EPOLLIN|select.EPOLLOUT)
+
+    def wake(self):
+        # makes run() look at every write queue now, rather than once poll()
+        # times out. called by Bot.queue_send, from any thread
+        if not self._awake:
+            self._awake = True
+            try:
+                os.write(self._wake_write, b"\0")
+            except BlockingIOError:
+                # the pipe's full, so run() will wake up regardless
+                pass
+
+    def _drain_wake(self):
+        try:
+            while os.read(self._wake_read, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def parse_line(self, line, bot):
+        if not line:
+            return
+
+        if not self.capture == None:
+            self.capture.write(bot.connection_id, Capture.INBOUND, line)
+
+        # Some telnet shells like to echo everything back.
+        # Fortunately, IRCDs will not return your prefix
+        if line.startswith(":{} ".format(bot.prefix)): return
+
+        log_message("raw", line, "info")
+
+        # Getting an END means this is a dead telnet connection,
+        # so it should be closed at the earliest opportunity
+        if line == "END":
+            return True
+
+        start = time.perf_counter()
+        IRCLineHandler.handle(IRCLine.parse(line), bot, self)
+        bot.metrics.dispatch.observe(time.perf_counter()-start)
+
+    def all(self, function, *args):
+        for bot in list(self.bots.values()):
+            function(bot, *args)
+
+    def start_capture(self, path, compress=None):
+        # records every line sent and received, for replay.py
+        self.stop_capture()
+        self.capture = Capture.CaptureWriter(path, compress)
+        for bot in list(self.bots.values()):
+            bot.capture = self.capture
+        return self.capture
+
+    def stop_capture(self):
+        capture, self.capture = self.capture, None
+        for bot in list(self.bots.values()):
+            bot.capture = None
+        if not capture == None:
+            capture.close()
+
+    def add_bot(self, bot):
+        bot.capture = self.capture
+        self.bots[bot.fileno()] = bot
+        self.poll.register(bot.fileno(), select.EPOLLIN)
+        bot.wake = self.wake
+        if bot.waiting_send():
+            self.wake()
+
+    def remove_bot(self, bot):
+        bot.wake = None
+        self.retired_metrics.add(bot.metrics)
+        self.channels.forget_bot(bot)
+        self.poll.unregister(bot.fileno())
+        del self.bots[bot.fileno()]
+        bot.socket.close()
+
+    def __len__(self):
+        return len(self.bots)
+
+    def run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def start(self):
+        self.loop_thread = threading.Thread(target=self.run_loop)
+        self.loop_thread.daemon = True
+        self.loop_thread.start()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self.thread
+
+    def metrics(self):
+        # cumulative totals across every bot there has been, see Metrics for
+        # Prometheus
+        summary = Metrics.total_metrics(self).summary()
+        summary["connections"] = len(self.bots)
+        summary["queued_bytes"] = sum(bot.queued_bytes
+            for bot in list(self.bots.values()))
+        return summary
+
+    def summary(self):
+        return ", ".join([a.summary() for a in self.bots.values()])
@@ -0,0 +1,90 @@
+import collections, gzip, io, struct, threading, time
+
+# a capture is MAGIC, then HEADER (the wall-clock time it started), then one
+# RECORD per line followed by the line itself, utf8 encoded without "\r\n".
+# the whole file may be gzipped
+MAGIC = b"CLCAP\x01"
+HEADER = struct.Struct("<d")
+# microseconds since the capture started, connection id, direction, length
+RECORD = struct.Struct("<QIBI")
+GZIP_MAGIC = b"\x1f\x8b"
+
+INBOUND = 0
+OUTBOUND = 1
+
+Record = collections.namedtuple("Record", ["timestamp", "connection_id",
+    "direction", "line"])
+
+class CaptureError(Exception):
+    pass
+
+class CaptureWriter(object):
+    # records lines from any thread, timed by the monotonic clock
+    def __init__(self, path, compress=None):
+        if compress == None:
+            compress = path.endswith(".gz")
+        self.path = path
+        self.compress = compress
+        if compress:
+            # a low level, this is written to from the epoll thread
+            self._file = gzip.open(path, "wb", compresslevel=1)
+        else:
+            self._file = open(path, "wb")
+        self._file.write(MAGIC+HEADER.pack(time.time()))
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+        self.records = 0
+        self.closed = False
+
+    def write(self, connection_id, direction, line):
+        data = line.encode("utf8", "surrogateescape")
+        timestamp = int((time.monotonic()-self._start)*1000000)
+        with self._lock:
+            if self.closed:
+                return
+            self._file.write(RECORD.pack(timestamp, connection_id, direction,
+                len(data)))
+            self._file.write(data)
+            self.records += 1
+
+    def close(self):
+        with self._lock:
+            if not self.closed:
+                self.closed = True
+                self._file.close()
+
+    def __repr__(self):
+        return "<CaptureWriter {} ({} records)>".format(self.path,
+            self.records)
+
+def open_capture(path):
+    f = open(path, "rb")
+    if f.peek(2)[:2] == GZIP_MAGIC:
+        f.close()
+        f = io.BufferedReader(gzip.open(path, "rb"))
+    return f
+
+def read_capture(path):
+    # returns the wall-clock time the capture started, and an iterator of
+    # Records with timestamps in seconds since then
+    f = open_capture(path)
+    if not f.read(len(MAGIC)) == MAGIC:
+        f.close()
+        raise CaptureError("{} isn't a capture".format(path))
+    started, = HEADER.unpack(f.read(HEADER.size))
+    return started, _read_records(f)
+
+def _read_records(f):
+    with f:
+        while True:
+            header = f.read(RECORD.size)
+            if not header:
+                return
+            if len(header) < RECORD.size:
+                raise CaptureError("truncated record")
+            timestamp, connection_id, direction, length = RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                raise CaptureError("truncated record")
+            yield Record(timestamp/1000000, connection_id, direction,
+                data.decode("utf8", "surrogateescape"))
@@ -0,0 +1,164 @@
+import sys
+
+class Channel(object):
+    __slots__ = ["name", "key", "members", "observers"]
+    def __init__(self, name, key):
+        self.name = name
+        self.key = key
+        # case-folded nickname -> prefix symbols (e.g. "@")
+        self.members = {}
+        # the bots in this channel, who all keep it up to date
+        self.observers = set([])
+    def __repr__(self):
+        return "<Channel {} ({} members)>".format(self.name, len(self.members))
+
+class User(object):
+    __slots__ = ["nickname", "username", "hostname", "realname", "channels"]
+    def __init__(self, nickname):
+        self.nickname = nickname
+        self.username = self.hostname = self.realname = None
+        # case-folded channel names
+        self.channels = set([])
+    def __repr__(self):
+        return "<User {}>".format(self.nickname)
+
+class ChannelStore(object):
+    # channel membership as seen by every bot on a server, so bots sharing a
+    # channel share one table. names are case-folded with the reporting bot's
+    # CASEMAPPING and interned
+    def __init__(self):
+        self.channels = {}
+        self.users = {}
+
+    def _key(self, bot, name):
+        return sys.intern(bot.isupport.casefold(name))
+
+    def get_channel(self, bot, name):
+        return self.channels.get(self._key(bot, name))
+    def get_user(self, bot, nickname):
+        return self.users.get(self._key(bot, nickname))
+
+    def is_member(self, bot, channel_name, nickname):
+        channel = self.get_channel(bot, channel_name)
+        return bool(channel) and self._key(bot, nickname) in channel.members
+
+    def members(self, bot, channel_name):
+        channel = self.get_channel(bot, channel_name)
+        return [self.users[key] for key in channel.members] if channel else []
+    def user_channels(self, bot, nickname):
+        user = self.get_user(bot, nickname)
+        return [self.channels[key] for key in user.channels] if user else []
+    def shared_channels(self, bot, nickname, other_nickname):
+        user = self.get_user(bot, nickname)
+        other_user = self.get_user(bot, other_nickname)
+        if not user or not other_user:
+            return []
+        return [self.channels[key] for key in user.channels & other_user.channels]
+
+    def _add_member(self, bot, channel, nickname, modes="", username=None,
+            hostname=None):
+        user_key = self._key(bot, nickname)
+        user = self.users.get(user_key)
+        if user == None:
+            user = self.users[user_key] = User(sys.intern(nickname))
+        if username:
+            user.username, user.hostname = username, hostname
+        if modes or not user_key in channel.members:
+            channel.members[user_key] = sys.intern(modes)
+        user.channels.add(channel.key)
+        return user
+
+    def _remove_member(self, channel, user_key):
+        if channel.members.pop(user_key, None) == None:
+            return
+        user = self.users.get(user_key)
+        if user:
+            user.channels.discard(channel.key)
+            if not user.channels:
+                del self.users[user_key]
+
+    def _drop_channel(self, channel):
+        for user_key in list(channel.members):
+            self._remove_member(channel, user_key)
+        del self.channels[channel.key]
+
+    def join(self, bot, channel_name, nickname, username=None, hostname=None):
+        key = self._key(bot, channel_name)
+        channel = self.channels.get(key)
+        if channel == None:
+            if not bot.is_own_nickname(nickname):
+                # we're not in it, so we couldn't keep it up to date anyway
+                return
+            channel = self.channels[key] = Channel(channel_name, key)
+        if bot.is_own_nickname(nickname):
+            channel.observers.add(bot)
+        self._add_member(bot, channel, nickname, "", username, hostname)
+
+    def part(self, bot, channel_name, nickname):
+        channel = self.get_channel(bot, channel_name)
+        if channel == None:
+            return
+        self._remove_member(channel, self._key(bot, nickname))
+        if bot.is_own_nickname(nickname):
+            self.forget(bot, channel)
+
+    def forget(self, bot, channel):
+        # bot is no longer in channel, so it can't keep it up to date
+        channel.observers.discard(bot)
+        if not channel.observers:
+            self._drop_channel(channel)
+
+    def forget_bot(self, bot):
+        for channel in list(self.channels.values()):
+            if bot in channel.observers:
+                self.forget(bot, channel)
+
+    def quit(self, bot, nickname):
+        user_key = self._key(bot, nickname)
+        user = self.users.get(user_key)
+        if user:
+            for channel_key in list(user.channels):
+                self._remove_member(self.channels[channel_key], user_key)
+
+    def nick(self, bot, old_nickname, new_nickname):
+        old_key = self._key(bot, old_nickname)
+        new_key = self._key(bot, new_nickname)
+        user = self.users.pop(old_key, None)
+        if user == None:
+            return
+        user.nickname = sys.intern(new_nickname)
+        self.users[new_key] = user
+        for channel_key in user.channels:
+            members = self.channels[channel_key].members
+            members[new_key] = members.pop(old_key)
+
+    def names(self, bot, channel_name, names):
+        # from 353 (RPL_NAMREPLY), with any multi-prefix or userhost-in-names
+        channel = self.get_channel(bot, channel_name)
+        if channel == None:
+            return
+        prefix_symbols = bot.isupport.prefix_symbols
+        for name in names:
+            nickname = name.lstrip(prefix_symbols)
+            modes = name[:len(name)-len(nickname)]
+            nickname, _, userhost = nickname.partition("!")
+            username, _, hostname = userhost.partition("@")
+            if nickname:
+                self._add_member(bot, channel, nickname, modes,
+                    username or None, hostname or None)
+
+    def who(self, bot, channel_name, nickname, username, hostname, flags,
+            realname):
+        # from 352 (RPL_WHOREPLY). flags are H or G, maybe *, then prefixes
+        channel = self.get_channel(bot, channel_name)
+        if channel == None:
+            return
+        modes = "".join(c for c in flags if c in bot.isupport.prefix_symbols)
+        user = self._add_member(bot, channel, nickname, "", username,
+            hostname)
+        user.realname = realname
+        channel.members[self._key(bot, nickname)] = sys.intern(modes)
+
+    def summary(self):
+        return "{} channels, {} users".format(len(self.channels),
+            len(self.users))
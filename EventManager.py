@@ -1,27 +1,264 @@
-import traceback
+import asyncio, bisect, collections, concurrent.futures, heapq, inspect
+import re, sys, threading, time
+import traceback, types, warnings
+
+import Instrumentation, Triggers
+
+NO_DATA = types.MappingProxyType({})
 
 class Event(object):
-    def __init__(self, server, name, **kwargs):
+    # values are looked up in kwargs, then in data: a read-only mapping
+    # shared by every event raised for the same thing (e.g. a LineData)
+    def __init__(self, server, name, data=NO_DATA, /, **kwargs):
         self.server = server
         self.name = name
+        self.data = data
         self.kwargs = kwargs
         self.eaten = False
     def __getitem__(self, key):
-        return self.kwargs[key]
+        if key in self.kwargs:
+            return self.kwargs[key]
+        return self.data[key]
     def get(self, key, default=None):
-        return self.kwargs.get(key, default)
+        if key in self.kwargs:
+            return self.kwargs[key]
+        return self.data.get(key, default)
     def __contains__(self, key):
-        return key in self.kwargs
+        return key in self.kwargs or key in self.data
     def eat(self):
         self.eaten = True
 
+class AsyncResult(concurrent.futures.Future):
+    # the result of a coroutine callback, running on the server's event loop.
+    # can be awaited from any event loop, or waited on with result()
+    def __init__(self, loop, coroutine):
+        concurrent.futures.Future.__init__(self)
+        loop.call_soon_threadsafe(self._start, loop, coroutine)
+    def _start(self, loop, coroutine):
+        if not self.set_running_or_notify_cancel():
+            coroutine.close()
+            return
+        loop.create_task(coroutine).add_done_callback(self._done)
+    def _done(self, task):
+        if task.cancelled():
+            self.set_exception(asyncio.CancelledError())
+        elif task.exception():
+            self.set_exception(task.exception())
+        else:
+            self.set_result(task.result())
+    def __await__(self):
+        return asyncio.wrap_future(self).__await__()
+
+OVERFLOW_BLOCK = "block"
+OVERFLOW_DROP = "drop"
+OVERFLOW_INLINE = "inline"
+
+class BoundedExecutor(object):
+    # a thread pool that holds at most queue_depth callbacks waiting for a
+    # worker. past that, submit() blocks, drops the callback (returning None)
+    # or runs it on the calling thread, depending on overflow
+    def __init__(self, max_workers=4, queue_depth=64,
+            overflow=OVERFLOW_BLOCK):
+        self.max_workers = max_workers
+        self.queue_depth = queue_depth
+        self.overflow = overflow
+        self.dropped = 0
+        self.inlined = 0
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self._slots = threading.BoundedSemaphore(max_workers+queue_depth)
+
+    def submit(self, function, *args):
+        if not self._slots.acquire(self.overflow == OVERFLOW_BLOCK):
+            if self.overflow == OVERFLOW_DROP:
+                self.dropped += 1
+                return None
+            self.inlined += 1
+            future = concurrent.futures.Future()
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(function(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        future = self._executor.submit(function, *args)
+        future.add_done_callback(self._done)
+        return future
+    def _done(self, future):
+        self._slots.release()
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait)
+
+PRIORITY_URGENT = 0
+PRIORITY_HIGH = 1
+PRIORITY_MEDIUM = 2
+PRIORITY_LOW = 3
+PRIORITY_MONITOR = 4
+
 class EventCallback(object):
-    def __init__(self, function, server, **kwargs):
+    def __init__(self, function, server, executor=None,
+            priority=PRIORITY_MEDIUM, order=0, event_hook=None, **kwargs):
         self.function = function
         self.server = server
+        self.executor = executor
+        self.priority = priority
+        self.order = order
+        self.event_hook = event_hook
+        self.cancelled = False
+        self.callback_list = None
+        # keyword filters, e.g. channel="#x": only events with these values
+        # are passed to this callback
         self.kwargs = kwargs
+        self.is_coroutine = inspect.iscoroutinefunction(function)
+    def matches(self, event):
+        for key, value in self.kwargs.items():
+            if not event.get(key) == value:
+                return False
+        return True
+    def __lt__(self, other):
+        # lower priorities first, then in the order they were hooked
+        return (self.priority, self.order) < (other.priority, other.order)
+    def unhook(self):
+        if not self.cancelled:
+            self.cancelled = True
+            self.event_hook._unhooked(self)
     def call(self, event):
-        return self.function(event)
+        if self.executor:
+            future = self.executor.submit(self.function, event)
+        elif self.is_coroutine:
+            future = AsyncResult(self.server.loop, self.function(event))
+        else:
+            return self.function(event)
+        if future:
+            future.add_done_callback(self._future_done)
+        return future
+    def _future_done(self, future):
+        if not future.cancelled() and future.exception():
+            self.event_hook._report_error(self, future.exception())
+
+class ErrorReporter(object):
+    # reports the first exception from each callback of each type, then only
+    # every sample'th, and no more than rate a second (with bursts of up to
+    # burst). reports go to output and to the "log/error" event, unless they
+    # come from a callback on that event, which would feed back into itself
+    def __init__(self, events, rate=1.0, burst=10, sample=1000,
+            output=sys.stderr):
+        self.events = events
+        self.rate = rate
+        self.burst = burst
+        self.sample = sample
+        self.output = output
+        # callback -> exception type -> count, dropped by forget() once the
+        # callback is unhooked
+        self.counts = {}
+        self.reported = 0
+        self.sampled_out = 0
+        self.rate_limited = 0
+        self.recursive = 0
+        self._tokens = burst
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+        self._reporting = threading.local()
+
+    def report(self, event_hook, callback, exception):
+        with self._lock:
+            counts = self.counts.get(callback)
+            if counts == None:
+                counts = {}
+                # forget() has been or is about to be called for it
+                if not callback.cancelled:
+                    self.counts[callback] = counts
+            count = counts[type(exception)] = counts.get(type(exception), 0)+1
+            if getattr(self._reporting, "active", False):
+                self.recursive += 1
+                return
+            if not count == 1 and count % self.sample:
+                self.sampled_out += 1
+                return
+            now = time.monotonic()
+            self._tokens = min(self.burst,
+                self._tokens+((now-self._last_refill)*self.rate))
+            self._last_refill = now
+            if self._tokens < 1:
+                self.rate_limited += 1
+                return
+            self._tokens -= 1
+            self.reported += 1
+
+        message = "Failed to call event callback {} on {} ({} time{})".format(
+            getattr(callback.function, "__qualname__", callback.function),
+            event_hook.path, count, "" if count == 1 else "s")
+        data = "".join(traceback.format_exception(type(exception),
+            exception, exception.__traceback__))
+        if self.output:
+            self.output.write("{}\n{}".format(message, data))
+        self._reporting.active = True
+        try:
+            self.events.single("log/error").call(message=message, data=data,
+                path=event_hook.path, callback=callback, exception=exception,
+                count=count)
+        finally:
+            self._reporting.active = False
+
+    def forget(self, callback):
+        with self._lock:
+            self.counts.pop(callback, None)
+
+    def stats(self):
+        with self._lock:
+            return {"reported": self.reported, "sampled_out": self.sampled_out,
+                "rate_limited": self.rate_limited, "recursive": self.recursive,
+                "distinct": sum(len(counts) for counts in self.counts.values())}
+
+class CallbackList(object):
+    # kept sorted, and replaced rather than modified so a call() already
+    # iterating it is unaffected. unhooked callbacks stay in it, skipped,
+    # until they make up half of it
+    def __init__(self):
+        self.callbacks = []
+        self.count = 0
+    def add(self, callback):
+        callbacks = list(self.callbacks)
+        bisect.insort(callbacks, callback)
+        self.callbacks = callbacks
+        self.count += 1
+        callback.callback_list = self
+    def removed(self):
+        self.count -= 1
+        if self.count*2 < len(self.callbacks):
+            self.callbacks = [callback for callback in self.callbacks
+                if not callback.cancelled]
+
+def compile_pattern(pattern):
+    # a "*" or "?" matches within one path segment, as in "numeric/4**",
+    # and a "**" segment matches any number of them, as in "received/**"
+    regex = []
+    for segment in pattern.lower().split("/"):
+        if segment == "**":
+            regex.append("[^/]+(?:/[^/]+)*")
+        else:
+            regex.append("".join("[^/]*" if c == "*" else "[^/]" if c == "?"
+                else re.escape(c) for c in segment))
+    return re.compile("/".join(regex)+"$")
+
+class PatternCallback(object):
+    # hooked on every existing and future descendant matching a pattern
+    def __init__(self, event_hook, pattern, function, kwargs):
+        self.event_hook = event_hook
+        self.pattern = pattern
+        self.regex = compile_pattern(pattern)
+        self.function = function
+        self.kwargs = kwargs
+        self.callbacks = []
+        self.cancelled = False
+    def _attach(self, event_hook):
+        self.callbacks.append(event_hook.hook(self.function, **self.kwargs))
+    def unhook(self):
+        if not self.cancelled:
+            self.cancelled = True
+            self.event_hook._patterns.remove(self)
+            for callback in self.callbacks:
+                callback.unhook()
 
 class MultipleEventHook(object):
     def __init__(self):
@@ -29,41 +266,315 @@ class MultipleEventHook(object):
     def _add(self, event_hook):
         self._event_hooks.add(event_hook)
     def hook(self, function, **kwargs):
-        for event_hook in self._event_hooks:
-            event_hook.hook(function, **kwargs)
+        return [event_hook.hook(function, **kwargs)
+            for event_hook in self._event_hooks]
     def call(self, max=None, **kwargs):
         for event_hook in self._event_hooks:
             event_hook.call(max, **kwargs)
+    def call_with(self, data, /, max=None, **kwargs):
+        for event_hook in self._event_hooks:
+            event_hook.call_with(data, max=max, **kwargs)
+
+class ReplayPolicy(object):
+    # how many events (max_count) and for how many seconds (max_age) a hook
+    # keeps events for replay=True before its first hook. None means no limit
+    def __init__(self, max_count=None, max_age=None):
+        self.max_count = max_count
+        self.max_age = max_age
+    def __repr__(self):
+        return "ReplayPolicy(max_count={}, max_age={})".format(
+            self.max_count, self.max_age)
+
+# storing events for replay costs every unhooked path an Event per call, so
+# it's off until set_replay_policy() turns it on for a subtree
+DEFAULT_REPLAY_POLICY = None
+DEFAULT_REPLAY_LIMIT = 10000
+
+class StoredEvent(object):
+    __slots__ = ["hook", "event", "time", "live"]
+    def __init__(self, hook, event, time):
+        self.hook = hook
+        self.event = event
+        self.time = time
+        self.live = True
+
+class ReplayStore(object):
+    # keeps every event stored for replay across a whole event tree in
+    # arrival order, so the oldest can be evicted once max_total is exceeded
+    def __init__(self, max_total=DEFAULT_REPLAY_LIMIT):
+        self.max_total = max_total
+        self.total = 0
+        self.stored = 0
+        self.released = 0
+        self.evictions = {"count": 0, "age": 0, "total": 0}
+        self._order = collections.deque()
+
+    def add(self, hook, event, now):
+        stored_event = StoredEvent(hook, event, now)
+        self._order.append(stored_event)
+        self.total += 1
+        self.stored += 1
+        return stored_event
+
+    def drop(self, stored_event, reason=None):
+        stored_event.live = False
+        self.total -= 1
+        if reason:
+            self.evictions[reason] += 1
+        else:
+            self.released += 1
+
+    def evict(self):
+        while not self.max_total == None and self.total > self.max_total:
+            stored_event = self._order.popleft()
+            if stored_event.live:
+                # a hook's buffer is in arrival order too, so the oldest live
+                # event overall is always the oldest in its own hook
+                stored_event.hook._stored_events.popleft()
+                self.drop(stored_event, "total")
+        if len(self._order) > (self.total*2)+64:
+            self._order = collections.deque(
+                stored_event for stored_event in self._order
+                if stored_event.live)
+
+    def set_limit(self, max_total):
+        self.max_total = max_total
+        self.evict()
+
+    def stats(self):
+        return {"retained": self.total, "limit": self.max_total,
+            "stored": self.stored, "released": self.released,
+            "evicted": dict(self.evictions)}
 
 class EventHook(object):
-    def __init__(self, server, name=None):
+    def __init__(self, server, name=None, parent=None):
         self.server = server
         self.name = name
+        self._parent = parent
+        self._root = parent._root if parent else self
+        if parent == None:
+            self.path = ""
+        elif parent.path:
+            self.path = "{}/{}".format(parent.path, name.lower())
+        else:
+            self.path = name.lower()
         self._children = {}
-        self._hooks = []
+        self._hooks = CallbackList()
+        # callbacks with keyword filters, by the key and value of one filter,
+        # so call() only looks at the ones that could match. see
+        # _replace_filtered
+        self._filtered_hooks = {}
+        self._patterns = []
+        self._trigger_engines = {}
+        self._hook_count = 0
+        self._hook_order = 0
         self._hook_notify = None
         self._child_notify = None
         self._call_notify = None
-        self._stored_events = []
-    def hook(self, function, replay=False, **kwargs):
-        callback = EventCallback(function, self.server, **kwargs)
+        self._hooked = False
+        if parent:
+            self._replay_policy = parent._replay_policy
+        else:
+            self._replay_policy = DEFAULT_REPLAY_POLICY
+            self._replay_store = ReplayStore()
+            self._instrumentation = None
+            self._error_reporter = ErrorReporter(self)
+        self._stored_events = None if self._replay_policy == None else (
+            collections.deque())
+        self._path_cache = {}
+    def hook(self, function, replay=False, executor=None,
+            priority=PRIORITY_MEDIUM, **kwargs):
+        # with an executor (e.g. a BoundedExecutor) the callback runs there and
+        # call() gets its future, so it can't eat() the event for later hooks.
+        # returns the callback, which can be unhook()ed
+        self._hook_order += 1
+        callback = EventCallback(function, self.server, executor, priority,
+            self._hook_order, self, **kwargs)
         if self._hook_notify:
             self._hook_notify(self, callback)
-        self._hooks.append(callback)
+        if kwargs:
+            key = min(kwargs)
+            callback_list = self._filtered_hooks.get(key, {}).get(kwargs[key])
+            if callback_list == None:
+                callback_list = CallbackList()
+                self._replace_filtered(key, kwargs[key], callback_list)
+            callback_list.add(callback)
+        else:
+            self._hooks.add(callback)
+        self._hook_count += 1
 
+        self._hooked = True
+        stored_events = self._release_stored_events()
+        if replay and self._replay_policy == None:
+            # nothing's kept for replay by default, don't let it look as if
+            # there was just nothing to catch up on
+            warnings.warn("{} has no replay policy, so replay=True has "
+                "nothing to replay; see set_replay_policy()".format(
+                self.path or "the root hook"), RuntimeWarning, stacklevel=2)
         if replay:
-            for event in self._stored_events:
-                callback.call(event)
+            max_age = self._replay_policy.max_age if self._replay_policy else None
+            now = time.monotonic()
+            for stored_event in stored_events:
+                if max_age == None or now-stored_event.time <= max_age:
+                    if callback.matches(stored_event.event):
+                        callback.call(stored_event.event)
+        return callback
+
+    def hook_pattern(self, pattern, function, **kwargs):
+        # e.g. events.hook_pattern("received/numeric/4**", function). the
+        # pattern is matched against a hook's path when it's created, not on
+        # each call. returns a PatternCallback, which can be unhook()ed
+        pattern_callback = PatternCallback(self, pattern, function, kwargs)
+        self._patterns.append(pattern_callback)
+        for descendant in self._descendants():
+            if pattern_callback.regex.match(self._relative_path(descendant)):
+                pattern_callback._attach(descendant)
+        return pattern_callback
+
+    def trigger(self, pattern, function, field="message"):
+        # function(event, match) is called for events whose field matches
+        # pattern, a command word ("!cmd") or a compiled regex. every trigger
+        # on a hook shares one callback, which tests all of them at once.
+        # returns a Trigger, which can be unhook()ed
+        engine = self._trigger_engines.get(field)
+        if engine == None:
+            engine = self._trigger_engines[field] = Triggers.TriggerEngine(
+                field, self)
+            self.hook(engine.dispatch)
+        return engine.add(pattern, function)
+
+    def _descendants(self):
+        for child in list(self._children.values()):
+            yield child
+            yield from child._descendants()
+    def _relative_path(self, descendant):
+        if self.path:
+            return descendant.path[len(self.path)+1:]
+        return descendant.path
+    def _match_patterns(self, descendant):
+        ancestor = self
+        while ancestor:
+            for pattern_callback in list(ancestor._patterns):
+                if pattern_callback.regex.match(ancestor._relative_path(
+                        descendant)):
+                    pattern_callback._attach(descendant)
+            ancestor = ancestor._parent
+
+    def _release_stored_events(self):
+        stored_events = self._stored_events or []
         self._stored_events = None
+        for stored_event in stored_events:
+            self._root._replay_store.drop(stored_event)
+        return stored_events
+
+    def _store_event(self, event):
+        policy = self._replay_policy
+        stored_events = self._stored_events
+        replay_store = self._root._replay_store
+        now = time.monotonic()
+        if not policy.max_age == None:
+            while stored_events and now-stored_events[0].time > policy.max_age:
+                replay_store.drop(stored_events.popleft(), "age")
+        if not policy.max_count == None:
+            while stored_events and len(stored_events) >= policy.max_count:
+                replay_store.drop(stored_events.popleft(), "count")
+        stored_events.append(replay_store.add(self, event, now))
+        # not until it's in stored_events, it might be what's evicted
+        replay_store.evict()
+
+    def set_replay_policy(self, policy, recursive=False):
+        # children created after this inherit the policy; None turns
+        # storing events for replay off
+        if policy and policy.max_count == 0:
+            policy = None
+        self._replay_policy = policy
+        if policy == None:
+            self._release_stored_events()
+        elif not self._hooked and self._stored_events == None:
+            self._stored_events = collections.deque()
+        if recursive:
+            for child in list(self._children.values()):
+                child.set_replay_policy(policy, recursive)
+    def get_replay_policy(self):
+        return self._replay_policy
+
+    def instrument(self, enabled=True):
+        # applies to the whole tree. turning it back on starts afresh
+        root = self._root
+        root._instrumentation = Instrumentation.Instrumentation(
+            ) if enabled else None
+        return root._instrumentation
+    def get_instrumentation(self):
+        return self._root._instrumentation
+
+    def _report_error(self, callback, exception):
+        self._root._error_reporter.report(self, callback, exception)
+    def get_error_reporter(self):
+        return self._root._error_reporter
+
+    def set_replay_limit(self, max_total):
+        self._root._replay_store.set_limit(max_total)
+    def replay_stats(self):
+        return self._root._replay_store.stats()
 
     def _unhook(self, hook):
-        self._hooks.remove(hook)
+        hook.unhook()
+    def _unhooked(self, hook):
+        self._hook_count -= 1
+        # nothing keyed on the callback should outlive it
+        root = self._root
+        root._error_reporter.forget(hook)
+        if root._instrumentation:
+            root._instrumentation.forget(hook)
+        hook.callback_list.removed()
+        if hook.kwargs and not hook.callback_list.count:
+            key = min(hook.kwargs)
+            if self._filtered_hooks.get(key, {}).get(hook.kwargs[key]
+                    ) is hook.callback_list:
+                self._replace_filtered(key, hook.kwargs[key], None)
+
+    def _replace_filtered(self, key, value, callback_list):
+        # like CallbackList, the index is replaced rather than modified so a
+        # call() already iterating it, maybe on another thread, is unaffected.
+        # a callback_list of None removes value
+        index = dict(self._filtered_hooks.get(key, {}))
+        if callback_list == None:
+            index.pop(value, None)
+        else:
+            index[value] = callback_list
+        filtered_hooks = dict(self._filtered_hooks)
+        if index:
+            filtered_hooks[key] = index
+        else:
+            filtered_hooks.pop(key, None)
+        self._filtered_hooks = filtered_hooks
+
+    def _callbacks(self, event):
+        callbacks = self._hooks.callbacks
+        filtered_hooks = self._filtered_hooks
+        if not filtered_hooks:
+            return callbacks
+        matching = [callbacks] if callbacks else []
+        for key, index in filtered_hooks.items():
+            try:
+                callback_list = index.get(event.get(key))
+            except TypeError:
+                continue
+            if callback_list:
+                matching.append(callback_list.callbacks)
+        if len(matching) == 1:
+            return matching[0]
+        return heapq.merge(*matching)
 
     def single(self, subpath):
-        subevents = subpath.split("/")
-        target = self
-        for subevent in subevents:
-            target = target.get_child(subevent)
+        # children are never replaced once created, so a resolved path stays
+        # valid for as long as this hook (and so this cache) is in use
+        target = self._path_cache.get(subpath)
+        if target == None:
+            target = self
+            for subevent in subpath.split("/"):
+                target = target.get_child(subevent)
+            self._path_cache[subpath] = target
         return target
 
     def on(self, subevent, *extra_subevents):
@@ -74,41 +585,77 @@ class EventHook(object):
             return multiple_event_hook
         return self.get_child(subevent)
 
+    def has_subscribers(self):
+        # anything that would see an event: callbacks, a call notifier, or
+        # the buffer kept for replay until the first hook
+        return bool(self._hook_count) or not self._call_notify == None or (
+            not self._stored_events == None)
+
     def call(self, max=None, **kwargs):
-        event = Event(self.server, self.name, **kwargs)
+        return self.call_with(NO_DATA, max=max, **kwargs)
+    def call_with(self, data, /, max=None, **kwargs):
+        # data is a mapping the event refers to rather than copies
+        if not self.has_subscribers():
+            return []
+        instrumentation = self._root._instrumentation
+        if instrumentation:
+            call_start = time.perf_counter()
+        event = Event(self.server, self.name, data, **kwargs)
         if self._call_notify:
             self._call_notify(self, event)
 
         if not self._stored_events == None:
-            self._stored_events.append(event)
+            self._store_event(event)
         called = 0
+        any_failed = False
         returns = []
-        for hook in self._hooks:
+        for hook in self._callbacks(event):
             if max and called == max:
                 break
             if event.eaten:
                 break
+            if hook.cancelled:
+                continue
+            if len(hook.kwargs) > 1 and not hook.matches(event):
+                continue
+            failed = False
+            if instrumentation:
+                start = time.perf_counter()
             try:
                 returns.append(hook.call(event))
             except Exception as e:
-                traceback.print_exc()
-                # TODO don't make this an event call. can lead to error cycles!
-                #self.bot.events.on("log").on("error").call(
-                #    message="Failed to call event callback",
-                #    data=traceback.format_exc())
+                failed = any_failed = True
+                if instrumentation:
+                    instrumentation.record(self, hook,
+                        time.perf_counter()-start, True)
+                self._report_error(hook, e)
+            if instrumentation and not failed:
+                instrumentation.record(self, hook, time.perf_counter()-start,
+                    False)
             called += 1
+        if instrumentation:
+            instrumentation.record_path(self, time.perf_counter()-call_start,
+                any_failed)
         return returns
     def get_child(self, child_name):
         child_name_lower = child_name.lower()
         if not child_name_lower in self._children:
             self._children[child_name_lower] = EventHook(self.server,
-                child_name)
+                child_name, self)
+            self._match_patterns(self._children[child_name_lower])
             if self._child_notify:
                 self._child_notify(self, self._children[
                     child_name_lower])
         return self._children[child_name_lower]
+    def find_child(self, child_name):
+        # get_child() without creating it, for names that come from outside
+        return self._children.get(child_name.lower())
     def get_hooks(self):
-        return self._hooks
+        callback_lists = [self._hooks]
+        for index in self._filtered_hooks.values():
+            callback_lists.extend(index.values())
+        return sorted(callback for callback_list in callback_lists
+            for callback in callback_list.callbacks if not callback.cancelled)
     def get_children(self):
         return self._children.keys()
     def set_hook_notify(self, handler):
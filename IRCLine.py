@@ -0,0 +1,76 @@
+TAG_UNESCAPES = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+
+def unescape_tag_value(value):
+    if not "\\" in value:
+        return value
+    unescaped = []
+    i = 0
+    while i < len(value):
+        c = value[i]
+        if c == "\\":
+            i += 1
+            if i < len(value):
+                unescaped.append(TAG_UNESCAPES.get(value[i], value[i]))
+        else:
+            unescaped.append(c)
+        i += 1
+    return "".join(unescaped)
+
+class IRCLine(object):
+    # a parsed line. parse() fills in everything but tags, which are only
+    # parsed the first time they're read
+    __slots__ = ["line", "tags_raw", "prefix", "command", "args", "is_final",
+        "_tags"]
+
+    @property
+    def tags(self):
+        if self._tags == None:
+            self._tags = self._parse_tags()
+        return self._tags
+
+    def _parse_tags(self):
+        tags = {}
+        if self.tags_raw:
+            for tag in self.tags_raw.split(";"):
+                key, _, value = tag.partition("=")
+                if key:
+                    tags[key] = unescape_tag_value(value)
+        return tags
+
+    def __repr__(self):
+        return "IRCLine({!r})".format(self.line)
+
+def parse(line):
+    # [@tags ][:prefix ]command[ params][ :trailing]. neither tags nor the
+    # prefix can have a space in, so once they're split off the first " :"
+    # starts the trailing parameter and everything before it splits on spaces
+    tags_raw = prefix = None
+    rest = line
+    if line and line[0] == "@":
+        tags_raw, _, rest = line.partition(" ")
+        tags_raw = tags_raw[1:]
+        rest = rest.lstrip(" ")
+    if rest and rest[0] == ":":
+        prefix, _, rest = rest.partition(" ")
+        prefix = prefix[1:]
+    middle, trailing, last = rest.partition(" :")
+    # only on spaces, split() with no argument would split on any unicode
+    # whitespace, which can be in channel names and other params
+    args = middle.split(" ")
+    if "" in args:
+        args = [arg for arg in args if arg]
+    command = args.pop(0) if args else ""
+    if trailing:
+        args.append(last)
+
+    # there's one of these per line read, and filling in the slots here is
+    # cheaper than passing them all to an __init__
+    parsed = IRCLine()
+    parsed.line = line
+    parsed.tags_raw = tags_raw
+    parsed.prefix = prefix
+    parsed.command = command
+    parsed.args = args
+    parsed.is_final = not trailing == ""
+    parsed._tags = None
+    return parsed
@@ -1,167 +1,365 @@
-import re, threading
-
-import Utils
-
-RE_PREFIXES = re.compile(r"\bPREFIX=\((\w+)\)(\W+)(?:\b|$)")
-RE_CHANMODES = re.compile(
-    r"\bCHANMODES=(\w*),(\w*),(\w*),(\w*)(?:\b|$)")
-RE_CHANTYPES = re.compile(r"\bCHANTYPES=(\W+)(?:\b|$)")
-
-handlers = {}
-descriptions = {}
-default_events = {}
-current_description = None
-current_default_event = False
-
-class LineData:
-    def __init__(self, line, line_split, prefix, command, args, is_final, bot, server):
-        self.line, self.prefix = line, prefix
-        self.command, self.args = command, args
-        self.is_final = is_final,
-        self.server, self.line_split = server, line_split
-        self.bot = bot
-        self.prefix_split = Utils.separate_hostmask(self.prefix) if self.prefix else (None, None, None)
+import collections, collections.abc, re, weakref
+
+import Numerics, Utils
+
+# per event tree, command -> (handler functions, default event hooks,
+# whether it's a numeric) and the registry generation it was built from
+command_tables = weakref.WeakKeyDictionary()
+
+class LineData(collections.abc.Mapping):
+    # a read-only mapping of these, which every event raised for a line refers
+    # to. anything past what the line was parsed into is worked out on demand
+    KEYS = ("line", "line_split", "prefix", "command", "args", "is_final",
+        "bot", "prefix_split", "tags")
+
+    def __init__(self, line, bot, server):
+        self.irc_line = line
+        self.line, self.prefix = line.line, line.prefix
+        self.command, self.args = line.command, line.args
+        self.is_final = line.is_final
+        self.server, self.bot = server, bot
+        self._line_split = self._prefix_split = None
+
+    @property
+    def tags(self):
+        return self.irc_line.tags
+    @property
+    def line_split(self):
+        if self._line_split == None:
+            self._line_split = self.line.split(" ")
+        return self._line_split
+    @property
+    def prefix_split(self):
+        if self._prefix_split == None:
+            self._prefix_split = Utils.separate_hostmask(self.prefix
+                ) if self.prefix else (None, None, None)
+        return self._prefix_split
+
+    def __getitem__(self, key):
+        if key in self.KEYS:
+            return getattr(self, key)
+        raise KeyError(key)
+    def __iter__(self):
+        return iter(self.KEYS)
+    def __len__(self):
+        return len(self.KEYS)
 
     def map(self):
-        return {
-            "line": self.line, "line_split": self.line_split,
-            "prefix": self.prefix, "command": self.command,
-            "args":  self.args, "is_final": self.is_final,
-            "bot": self.bot, "prefix_split": self.prefix_split,
-            }
-
-def handler(f=None, description=None, default_event=False):
-    global current_description, current_default_event
-    if not f:
-        current_description = description
-        current_default_event = default_event
-        return handler
-    name = f.__name__.split("handle_")[1].upper()
-    handlers[name] = f
-
-    descriptions[name] = current_description
-    default_events[name] = current_default_event
-    current_description, current_default_event = None, False
-
-def handle(line, prefix, command, args, is_final, bot, server):
-    line_split = line.split(" ")
-    data = LineData(line, line_split, prefix, command, args, is_final, bot, server)
-    handler_function = None
-
-    if command in handlers:
-        handler_function = handlers[command]
-    if default_events.get(command, False) or not command in handlers:
-        if command.isdigit():
-            server.events.on("received").on("numeric").call(
-                number=command, **data.map())
-            server.events.on("received").on("numeric").on(
-                command).call(number=command, **data.map())
+        return dict(self)
+
+HandlerEntry = collections.namedtuple("HandlerEntry",
+    ["functions", "paths", "is_numeric"])
+
+class HandlerRegistry(object):
+    # command -> the functions that handle it and, when none of them replace
+    # them, the paths of the events it's raised as by default. numerics can
+    # also be handled by range (e.g. Numerics.ERRORS), after any handler for
+    # that specific numeric
+    def __init__(self):
+        self.handlers = {}
+        self.range_handlers = []
+        self.descriptions = {}
+        self.generation = 0
+        self._entries = {}
+
+    def register(self, commands, function, description=None,
+            default_event=False):
+        # commands is a command, a list of them or a range of numerics
+        if isinstance(commands, range):
+            self.range_handlers.append((commands, function, default_event))
+        else:
+            if isinstance(commands, str):
+                commands = [commands]
+            for command in commands:
+                self.handlers[command.upper()] = (function, default_event)
+        self.descriptions[function] = description
+        self.generation += 1
+        self._entries.clear()
+
+    def handler(self, commands, description=None, default_event=False):
+        def decorator(function):
+            self.register(commands, function, description, default_event)
+            return function
+        return decorator
+
+    def get(self, command):
+        entry = self._entries.get(command)
+        if entry == None:
+            entry = self._entries[command] = self._build(command)
+        return entry
+
+    def _build(self, command):
+        handlers = []
+        if command in self.handlers:
+            handlers.append(self.handlers[command])
+        is_numeric = command.isdigit()
+        if is_numeric:
+            number = int(command)
+            handlers.extend((function, default_event) for numerics, function,
+                default_event in self.range_handlers if number in numerics)
+
+        paths = ()
+        if not handlers or any(default_event for _, default_event in handlers):
+            if is_numeric:
+                paths = ("received/numeric",
+                    "received/numeric/{}".format(command))
+            else:
+                paths = ("received/{}".format(command),)
+        return HandlerEntry(tuple(function for function, _ in handlers),
+            paths, is_numeric)
+
+registry = HandlerRegistry()
+handler = registry.handler
+
+def command_entry(events, command):
+    table = command_tables.get(events)
+    if table == None or not table[0] == registry.generation:
+        table = command_tables[events] = (registry.generation, {})
+    entry = table[1].get(command)
+    if entry == None:
+        handler_entry = registry.get(command)
+        entry = table[1][command] = (handler_entry.functions, tuple(
+            events.single(path) for path in handler_entry.paths),
+            handler_entry.is_numeric)
+    return entry
+
+def emit(hook, data, **kwargs):
+    # only build an event when something will see it
+    if hook.has_subscribers():
+        return hook.call_with(data, **kwargs)
+    return []
+
+def handle(line, bot, server):
+    # line is a parsed IRCLine
+    data = LineData(line, bot, server)
+    command = data.command
+    functions, hooks, is_numeric = command_entry(server.events, command)
+
+    for hook in hooks:
+        if is_numeric:
+            emit(hook, data, number=command)
         else:
-            server.events.on("received").on(command).call(**data.map())
-    if handler_function:
-        handler_function(data)
+            emit(hook, data)
+    for function in functions:
+        function(data)
 
-@handler(description="reply to a ping")
+@handler("PING", description="reply to a ping")
 def handle_PING(data):
     nonce = data.args[0]
     data.bot.send_pong(nonce)
-    data.server.events.on("received").on("ping").call(nonce=nonce, **data.map())
+    emit(data.server.events.single("received/ping"), data, nonce=nonce)
+
+@handler("PONG", description="the server answering our ping")
+def handle_PONG(data):
+    data.bot.pong_received()
+    emit(data.server.events.single("received/pong"), data,
+        nonce=data.args[-1] if data.args else None)
+
+@handler(Numerics.ERRORS, description="the server is refusing something",
+    default_event=True)
+def handle_error(data):
+    message = data.args[-1] if data.args else ""
+    emit(data.server.events.single("received/error"), data,
+        number=data.command, message=message)
 
-@handler(description="the first line sent to a registered client", default_event=True)
+@handler(Numerics.RPL_WELCOME,
+    description="the first line sent to a registered client",
+    default_event=True)
 def handle_001(data):
     data.bot.nickname = data.args[0]
 
-@handler(description="on user joining channel")
+@handler(Numerics.RPL_ISUPPORT,
+    description="the server is telling us what it supports",
+    default_event=True)
+def handle_005(data):
+    # the last argument is the "are supported by this server" text
+    tokens = data.args[1:-1] if data.is_final else data.args[1:]
+    data.bot.isupport.parse_tokens(tokens)
+
+@handler("JOIN", description="on user joining channel")
 def handle_JOIN(data):
     server, bot = data.server, data.bot
-    nickname, username, hostname = Utils.separate_hostmask(data.prefix)
+    nickname, username, hostname = data.prefix_split
     channel = Utils.remove_colon(data.args[0])
+    server.channels.join(bot, channel, nickname, username, hostname)
     if not bot.is_own_nickname(nickname):
-        server.events.on("received").on("join").call(channel=channel,
-            user=nickname, **data.map())
+        emit(server.events.single("received/join"), data, channel=channel,
+            user=nickname)
     else:
         bot.add_channel(channel)
-        server.events.on("self").on("join").call(channel=channel, **data.map())
+        emit(server.events.single("self/join"), data, channel=channel)
         bot.send_who(channel)
 
-@handler(description="on user parting channel")
+@handler("PART", description="on user parting channel")
 def handle_PART(data):
     server = data.server
-    nickname, username, hostname = Utils.separate_hostmask(data.prefix)
+    nickname, username, hostname = data.prefix_split
     channel = data.args[0]
     reason = data.args[1] if len(data.args) > 1 else ""
+    server.channels.part(data.bot, channel, nickname)
     if not data.bot.is_own_nickname(nickname):
-        server.events.on("received").on("part").call(channel=channel,
-            reason=reason, user=nickname, **data.map())
+        emit(server.events.single("received/part"), data, channel=channel,
+            reason=reason, user=nickname)
     else:
         data.bot.remove_channel(channel)
-        server.events.on("self").on("part").call(channel=channel,
-            reason=reason, **data.map())
+        emit(server.events.single("self/part"), data, channel=channel,
+            reason=reason)
 
-@handler(description="oh noes")
+@handler("KICK", description="oh noes")
 def handle_KICK(data):
     server, bot = data.server, data.bot
-    nickname, username, hostname = Utils.separate_hostmask(data.prefix)
+    nickname, username, hostname = data.prefix_split
     channel = data.args[0]
     target_nick = data.args[1]
     reason = data.args[2] if len(data.args) > 2 else ""
+    server.channels.part(bot, channel, target_nick)
     if data.bot.is_own_nickname(target_nick):
         data.bot.remove_channel(channel)
-        server.events.on("self").on("kick").call(channel=channel,
-            reason=reason, **data.map())
+        emit(server.events.single("self/kick"), data, channel=channel,
+            reason=reason)
     else:
-        server.events.on("received").on("kick").call(channel=channel,
-            reason=reason, user=target_nick, **data.map())
+        emit(server.events.single("received/kick"), data, channel=channel,
+            reason=reason, user=target_nick)
+
+@handler("QUIT", description="someone has disconnected")
+def handle_QUIT(data):
+    nickname, username, hostname = data.prefix_split
+    reason = data.args[0] if data.args else ""
+    data.server.channels.quit(data.bot, nickname)
+    emit(data.server.events.single("received/quit"), data, user=nickname,
+        reason=reason)
 
-@handler(description="The server is telling us about its capabilities!")
+@handler(Numerics.RPL_NAMREPLY, description="a list of who's in a channel",
+    default_event=True)
+def handle_353(data):
+    data.server.channels.names(data.bot, data.args[2], data.args[3].split())
+
+@handler(Numerics.RPL_WHOREPLY,
+    description="details of someone in a channel", default_event=True)
+def handle_352(data):
+    # the last argument is "<hopcount> <realname>"
+    realname = data.args[7].split(" ", 1)[1] if " " in data.args[7] else ""
+    data.server.channels.who(data.bot, data.args[1], data.args[5],
+        data.args[2], data.args[3], data.args[6], realname)
+
+@handler("CAP",
+    description="The server is telling us about its capabilities!")
 def handle_CAP(data):
     capability_list = []
     if len(data.args) > 2:
         capability_list = data.args[2].split()
-    data.server.events.on("received").on("cap").call(subcommand=data.args[1],
-        capabilities=capability_list, **data.map())
+    emit(data.server.events.single("received/cap"), data,
+        subcommand=data.args[1], capabilities=capability_list)
 
-@handler(description="The server is asking for authentication")
+@handler("AUTHENTICATE",
+    description="The server is asking for authentication")
 def handle_AUTHENTICATE(data):
-    data.server.events.on("received").on("authenticate").call(message=data.args[0],
-        **data.map())
+    emit(data.server.events.single("received/authenticate"), data,
+        message=data.args[0])
 
-@handler(description="someone has changed their nickname")
+@handler("NICK", description="someone has changed their nickname")
 def handle_NICK(data):
     new_nickname = data.args[0]
     old_nickname = data.prefix_split[0]
-    if old_nickname != data.bot.nickname:
-        data.server.events.on("received").on("nick").call(new_nickname=new_nickname,
-            old_nickname=old_nickname, **data.map())
+    data.server.channels.nick(data.bot, old_nickname, new_nickname)
+    if not data.bot.is_own_nickname(old_nickname):
+        emit(data.server.events.single("received/nick"), data,
+            new_nickname=new_nickname, old_nickname=old_nickname)
     else:
         data.bot.nickname = new_nickname
-        data.server.events.on("self").on("nick").call(new_nickname=new_nickname,
-            old_nickname=old_nickname, **data.map())
+        emit(data.server.events.single("self/nick"), data,
+            new_nickname=new_nickname, old_nickname=old_nickname)
 
-@handler(description="I've been invited somewhere")
+@handler("INVITE", description="I've been invited somewhere")
 def handle_INVITE(data):
-    nickname, username, hostname = Utils.separate_hostmask(data.prefix)
+    nickname, username, hostname = data.prefix_split
     target_channel = Utils.remove_colon(data.args[1])
-    data.server.events.on("received").on("invite").call(
-        user=nickname, target_channel=target_channel, **data.map())
+    emit(data.server.events.single("received/invite"), data, user=nickname,
+        target_channel=target_channel)
 
-@handler(description="we've received a message")
-def handle_PRIVMSG(data):
+class MessageData(collections.abc.Mapping):
+    # a PRIVMSG or NOTICE's LineData plus its message, whose split and
+    # formatting-stripped forms are only worked out if something reads them
+    KEYS = LineData.KEYS+("message", "message_split", "message_stripped")
+
+    def __init__(self, data, message):
+        self.data = data
+        self.message = message
+        self._message_split = self._message_stripped = None
+
+    @property
+    def message_split(self):
+        if self._message_split == None:
+            self._message_split = self.message.split(" ")
+        return self._message_split
+    @property
+    def message_stripped(self):
+        if self._message_stripped == None:
+            self._message_stripped = Utils.strip_formatting(self.message)
+        return self._message_stripped
+
+    def __getitem__(self, key):
+        if key == "message":
+            return self.message
+        elif key == "message_split":
+            return self.message_split
+        elif key == "message_stripped":
+            return self.message_stripped
+        return self.data[key]
+    def __iter__(self):
+        return iter(self.KEYS)
+    def __len__(self):
+        return len(self.KEYS)
+
+# CTCP commands come from anyone, so they're kept to something that can't
+# make a path of its own
+CTCP_COMMAND = re.compile("[A-Z0-9-]{1,32}")
+
+def parse_ctcp(message):
+    # "\x01COMMAND args\x01", where the closing \x01 is optional
+    if message.endswith("\x01"):
+        message = message[1:-1]
+    else:
+        message = message[1:]
+    command, _, args = message.partition(" ")
+    return command.upper(), args
+
+def handle_message(data, kind, ctcp_kind):
     server = data.server
-    nickname, username, hostname = Utils.separate_hostmask(data.prefix)
-    user = nickname
+    user = data.prefix_split[0]
     message = "" if len(data.args) < 2 else data.args[1]
-    message_split = message.split(" ")
     target = data.args[0]
-    action = message.startswith("\01ACTION ") and message.endswith("\01")
-    if action:
-        message = message.replace("\01ACTION ", "", 1)[:-1]
-    if target[0] in ["#", "&"]:
-        channel = data.args[0]
-        server.events.on("received").on("message").on("channel").call(
-            user=user, message=message, message_split=message_split,
-            channel=channel, action=action, **data.map())
-    elif target==data.bot.nickname:
-        server.events.on("received").on("message").on("private").call(
-            user=user, message=message, message_split=message_split,
-            action=action, **data.map())
+    action = False
+    if message[:1] == "\x01":
+        ctcp_command, ctcp_args = parse_ctcp(message)
+        # with no command, e.g. a lone "\x01", it's left as a plain message
+        if ctcp_command == "ACTION":
+            action, message = True, ctcp_args
+        elif ctcp_command:
+            # only to a hook that's already there, creating one (and a path
+            # cache entry) for every command anyone sends would never be freed
+            hook = server.events.single("received/{}".format(ctcp_kind)
+                ).find_child(ctcp_command) if CTCP_COMMAND.fullmatch(
+                ctcp_command) else None
+            if not hook == None:
+                emit(hook, data, user=user, target=target,
+                    ctcp_command=ctcp_command, ctcp_args=ctcp_args)
+            return
+    if data.bot.isupport.is_channel(target):
+        hook = server.events.single("received/{}/channel".format(kind))
+        if hook.has_subscribers():
+            hook.call_with(MessageData(data, message), user=user,
+                channel=target, action=action)
+    elif data.bot.is_own_nickname(target):
+        hook = server.events.single("received/{}/private".format(kind))
+        if hook.has_subscribers():
+            hook.call_with(MessageData(data, message), user=user,
+                action=action)
+
+@handler("PRIVMSG", description="we've received a message")
+def handle_PRIVMSG(data):
+    handle_message(data, "message", "ctcp")
+
+@handler("NOTICE", description="we've received a notice", default_event=True)
+def handle_NOTICE(data):
+    handle_message(data, "notice", "ctcp-reply")
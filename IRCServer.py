@@ -0,0 +1,355 @@
+import asyncio, random, threading, time
+
+import IRCLine, ISupport
+
+# what the server sends in 005
+ISUPPORT_TOKENS = ["CHANTYPES=#", "PREFIX=(ov)@+", "CASEMAPPING=rfc1459",
+    "NICKLEN=30"]
+
+class Client(object):
+    # someone on the server. generated users have no writer and never read
+    def __init__(self, server, writer=None):
+        self.server = server
+        self.writer = writer
+        self.nickname = None
+        self.username = None
+        self.realname = None
+        self.hostname = "127.0.0.1"
+        self.registered = False
+        # case-folded channel names
+        self.channels = set([])
+
+    def hostmask(self):
+        return "{}!{}@{}".format(self.nickname, self.username, self.hostname)
+
+    def send(self, line):
+        if self.writer == None or self.writer.is_closing():
+            return
+        data = (line+"\r\n").encode("utf8")
+        self.server.lines_out += 1
+        if self.server.latency:
+            self.server.loop.call_later(self.server.latency, self._write, data)
+        else:
+            self._write(data)
+
+    def _write(self, data):
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+    def numeric(self, numeric, *args):
+        self.send(":{} {} {} {}".format(self.server.name, numeric,
+            self.nickname or "*", " ".join(args)))
+
+class Channel(object):
+    def __init__(self, name):
+        self.name = name
+        # case-folded nickname -> Client
+        self.members = {}
+        self.operators = set([])
+
+class IRCServer(object):
+    # a small IRC server for exercising bots over loopback: registration,
+    # PING/PONG, JOIN/PART, PRIVMSG/NOTICE, NAMES, WHO and QUIT, nothing
+    # else. every line it sends is held back by latency seconds. it runs an
+    # event loop on its own thread, see start()
+    def __init__(self, host="127.0.0.1", port=0, name="irc.test",
+            latency=0.0):
+        self.host = host
+        self.port = port
+        self.name = name
+        self.latency = latency
+        self.isupport = ISupport.ISupport()
+        self.isupport.parse_tokens(ISUPPORT_TOKENS)
+        self.clients = {}
+        self.channels = {}
+        self.lines_in = 0
+        self.lines_out = 0
+        self.loop = None
+        self._server = None
+        self._thread = None
+        self._started = threading.Event()
+
+    def start(self):
+        # returns (host, port) once the server is listening
+        self._thread = threading.Thread(target=self._run, name="IRCServer")
+        self._thread.daemon = True
+        self._thread.start()
+        self._started.wait()
+        return self.host, self.port
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self._server = self.loop.run_until_complete(asyncio.start_server(
+            self._connected, self.host, self.port))
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._started.set()
+        self.loop.run_forever()
+
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks,
+            return_exceptions=True))
+        self.loop.close()
+
+    def stop(self):
+        def stop():
+            self._server.close()
+            for client in list(self.clients.values()):
+                if not client.writer == None:
+                    client.writer.close()
+            self.loop.stop()
+        self.loop.call_soon_threadsafe(stop)
+        self._thread.join(5)
+
+    def call(self, function, *args):
+        # runs function on the server's thread, from any other
+        return asyncio.run_coroutine_threadsafe(self._call(function, *args),
+            self.loop).result()
+    async def _call(self, function, *args):
+        return function(*args)
+
+    async def _connected(self, reader, writer):
+        client = Client(self, writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.lines_in += 1
+                line = line.decode("utf8", "replace").rstrip("\r\n")
+                if line and self.handle(client, IRCLine.parse(line)):
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            # cancelled by stop()
+            pass
+        self.quit(client, "Connection closed")
+        writer.close()
+
+    def handle(self, client, line):
+        # client-supplied prefixes are ignored, as real servers do
+        function = getattr(self, "on_{}".format(line.command.upper()), None)
+        if function == None:
+            client.numeric("421", line.command, ":Unknown command")
+        elif not client.registered and not line.command.upper() in [
+                "NICK", "USER", "PING", "PONG", "QUIT"]:
+            client.numeric("451", ":You have not registered")
+        else:
+            return function(client, line.args)
+
+    def _register(self, client):
+        if client.registered or not client.nickname or not client.username:
+            return
+        client.registered = True
+        self.clients[self.isupport.casefold(client.nickname)] = client
+        client.numeric("001", ":Welcome to {}, {}".format(self.name,
+            client.nickname))
+        client.numeric("005", " ".join(ISUPPORT_TOKENS),
+            ":are supported by this server")
+        client.numeric("422", ":MOTD File is missing")
+
+    def on_NICK(self, client, args):
+        if not args:
+            return client.numeric("431", ":No nickname given")
+        key = self.isupport.casefold(args[0])
+        if key in self.clients and not self.clients[key] is client:
+            return client.numeric("433", args[0], ":Nickname is in use")
+        if client.registered:
+            old_key = self.isupport.casefold(client.nickname)
+            self._broadcast_common(client, ":{} NICK :{}".format(
+                client.hostmask(), args[0]), True)
+            del self.clients[old_key]
+            self.clients[key] = client
+            for channel_key in client.channels:
+                members = self.channels[channel_key].members
+                members[key] = members.pop(old_key)
+            client.nickname = args[0]
+        else:
+            client.nickname = args[0]
+            self._register(client)
+
+    def on_USER(self, client, args):
+        if len(args) < 4:
+            return client.numeric("461", "USER", ":Not enough parameters")
+        client.username, client.realname = "~"+args[0], args[3]
+        self._register(client)
+
+    def on_PING(self, client, args):
+        client.send(":{0} PONG {0} :{1}".format(self.name,
+            args[-1] if args else ""))
+
+    def on_PONG(self, client, args):
+        pass
+
+    def on_QUIT(self, client, args):
+        self.quit(client, "Quit: {}".format(args[0] if args else ""))
+        return True
+
+    def quit(self, client, reason):
+        if not client.registered:
+            return
+        self._broadcast_common(client, ":{} QUIT :{}".format(
+            client.hostmask(), reason), False)
+        key = self.isupport.casefold(client.nickname)
+        for channel_key in list(client.channels):
+            self._leave(client, channel_key)
+        self.clients.pop(key, None)
+        client.registered = False
+
+    def _broadcast_common(self, client, line, include_self):
+        # to everyone sharing a channel with client, once each
+        recipients = set([])
+        for channel_key in client.channels:
+            recipients.update(self.channels[channel_key].members.values())
+        if include_self:
+            recipients.add(client)
+        else:
+            recipients.discard(client)
+        for recipient in recipients:
+            recipient.send(line)
+
+    def _leave(self, client, channel_key):
+        channel = self.channels[channel_key]
+        del channel.members[self.isupport.casefold(client.nickname)]
+        channel.operators.discard(client)
+        client.channels.discard(channel_key)
+        if not channel.members:
+            del self.channels[channel_key]
+
+    def join(self, client, name):
+        if not self.isupport.is_channel(name):
+            return client.numeric("403", name, ":No such channel")
+        key = self.isupport.casefold(name)
+        if key in client.channels:
+            return
+        channel = self.channels.get(key)
+        if channel == None:
+            channel = self.channels[key] = Channel(name)
+            channel.operators.add(client)
+        channel.members[self.isupport.casefold(client.nickname)] = client
+        client.channels.add(key)
+        line = ":{} JOIN {}".format(client.hostmask(), channel.name)
+        for member in channel.members.values():
+            member.send(line)
+        self.on_NAMES(client, [channel.name])
+
+    def on_JOIN(self, client, args):
+        if not args:
+            return client.numeric("461", "JOIN", ":Not enough parameters")
+        for name in args[0].split(","):
+            self.join(client, name)
+
+    def on_PART(self, client, args):
+        if not args:
+            return client.numeric("461", "PART", ":Not enough parameters")
+        for name in args[0].split(","):
+            key = self.isupport.casefold(name)
+            if not key in client.channels:
+                client.numeric("442", name, ":You're not on that channel")
+                continue
+            channel = self.channels[key]
+            line = ":{} PART {}".format(client.hostmask(), channel.name)
+            if len(args) > 1:
+                line += " :{}".format(args[1])
+            for member in channel.members.values():
+                member.send(line)
+            self._leave(client, key)
+
+    def message(self, client, command, target, text):
+        line = ":{} {} {} :{}".format(client.hostmask(), command, target, text)
+        key = self.isupport.casefold(target)
+        if self.isupport.is_channel(target):
+            channel = self.channels.get(key)
+            if channel == None:
+                return client.numeric("403", target, ":No such channel")
+            for member in channel.members.values():
+                if not member is client:
+                    member.send(line)
+        elif key in self.clients:
+            self.clients[key].send(line)
+        else:
+            client.numeric("401", target, ":No such nick/channel")
+
+    def on_PRIVMSG(self, client, args):
+        if len(args) < 2:
+            return client.numeric("412", ":No text to send")
+        for target in args[0].split(","):
+            self.message(client, "PRIVMSG", target, args[1])
+
+    def on_NOTICE(self, client, args):
+        if len(args) > 1:
+            for target in args[0].split(","):
+                self.message(client, "NOTICE", target, args[1])
+
+    def _prefixed_nickname(self, channel, member):
+        return ("@" if member in channel.operators else "")+member.nickname
+
+    def on_NAMES(self, client, args):
+        channel = self.channels.get(self.isupport.casefold(args[0])
+            ) if args else None
+        if not channel == None:
+            names = [self._prefixed_nickname(channel, member)
+                for member in channel.members.values()]
+            # keep each 353 well inside 512 bytes
+            for i in range(0, len(names), 40):
+                client.numeric("353", "=", channel.name,
+                    ":"+" ".join(names[i:i+40]))
+        client.numeric("366", args[0] if args else "*",
+            ":End of /NAMES list")
+
+    def on_WHO(self, client, args):
+        channel = self.channels.get(self.isupport.casefold(args[0])
+            ) if args else None
+        if not channel == None:
+            for member in channel.members.values():
+                flags = "H"+("@" if member in channel.operators else "")
+                client.numeric("352", channel.name, member.username,
+                    member.hostname, self.name, member.nickname, flags,
+                    ":0 {}".format(member.realname))
+        client.numeric("315", args[0] if args else "*", ":End of /WHO list")
+
+    def add_user(self, nickname, channels=[]):
+        # a user with no connection, for generate() to speak as. must be
+        # called on the server's thread, e.g. with call()
+        client = Client(self)
+        client.nickname, client.username, client.realname = (nickname,
+            "~"+nickname, nickname)
+        client.hostname = "generated.{}".format(self.name)
+        self._register(client)
+        for channel in channels:
+            self.join(client, channel)
+        return client
+
+    def generate(self, channel, rate, count=None, users=10, length=50):
+        # starts users generated users in channel saying a length-character
+        # message rate times a second between them, count times or until
+        # the returned future is cancelled. each message starts with the
+        # time.monotonic() it was sent at, to measure latency by
+        return asyncio.run_coroutine_threadsafe(self._generate(channel, rate,
+            count, users, length), self.loop)
+
+    async def _generate(self, channel, rate, count, users, length):
+        clients = [self.add_user("gen{}_{}".format(len(self.clients), i),
+            [channel]) for i in range(users)]
+        padding = "x"*length
+        interval = 1/rate
+        next_time = time.monotonic()
+        sent = 0
+        try:
+            while count == None or sent < count:
+                now = time.monotonic()
+                if next_time > now:
+                    await asyncio.sleep(next_time-now)
+                # catch up in bursts rather than drifting when we're late
+                while next_time <= time.monotonic() and (
+                        count == None or sent < count):
+                    text = "{:.6f} {}".format(time.monotonic(), padding)
+                    self.message(random.choice(clients), "PRIVMSG", channel,
+                        text[:max(length, 18)])
+                    sent += 1
+                    next_time += interval
+        finally:
+            for client in clients:
+                self.quit(client, "generator finished")
+        return sent
@@ -0,0 +1,59 @@
+import re
+
+RE_PREFIXES = re.compile(r"\bPREFIX=\((\w+)\)(\W+)(?:\b|$)")
+RE_CHANMODES = re.compile(
+    r"\bCHANMODES=(\w*),(\w*),(\w*),(\w*)(?:\b|$)")
+RE_CHANTYPES = re.compile(r"\bCHANTYPES=(\W+)(?:\b|$)")
+
+ASCII_UPPER = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+ASCII_LOWER = "abcdefghijklmnopqrstuvwxyz"
+CASEMAPPINGS = {
+    "ascii": str.maketrans(ASCII_UPPER, ASCII_LOWER),
+    "rfc1459": str.maketrans(ASCII_UPPER+"[]\\~", ASCII_LOWER+"{}|^"),
+    "strict-rfc1459": str.maketrans(ASCII_UPPER+"[]\\", ASCII_LOWER+"{}|"),
+    }
+
+class ISupport(object):
+    # what a server has told us about itself in 005 (RPL_ISUPPORT), with
+    # RFC 1459's defaults until it does
+    def __init__(self):
+        self.tokens = {}
+        self.casemapping = "rfc1459"
+        self.chantypes = "#&"
+        self.prefix_modes, self.prefix_symbols = "ov", "@+"
+        self.chanmodes = ("beI", "k", "l", "imnpst")
+        self._casemap = CASEMAPPINGS[self.casemapping]
+
+    def parse_tokens(self, tokens):
+        for token in tokens:
+            if token.startswith("-"):
+                self.tokens.pop(token[1:], None)
+                continue
+            key, _, value = token.partition("=")
+            self.tokens[key] = value
+
+            if key == "CASEMAPPING" and value in CASEMAPPINGS:
+                self.casemapping = value
+                self._casemap = CASEMAPPINGS[value]
+            elif key == "CHANTYPES":
+                match = RE_CHANTYPES.match(token)
+                self.chantypes = match.group(1) if match else ""
+            elif key == "PREFIX":
+                match = RE_PREFIXES.match(token)
+                if match:
+                    self.prefix_modes, self.prefix_symbols = match.groups()
+                elif not value:
+                    self.prefix_modes = self.prefix_symbols = ""
+            elif key == "CHANMODES":
+                match = RE_CHANMODES.match(token)
+                if match:
+                    self.chanmodes = match.groups()
+
+    def casefold(self, s):
+        return s.translate(self._casemap)
+
+    def equals(self, a, b):
+        return a.translate(self._casemap) == b.translate(self._casemap)
+
+    def is_channel(self, target):
+        return bool(target) and target[0] in self.chantypes
@@ -0,0 +1,104 @@
+import heapq, threading
+
+class CallStats(object):
+    # latency histogram buckets are powers of two in microseconds: bucket n
+    # holds calls that took less than 2**n us
+    BUCKETS = 32
+    def __init__(self, path, function=None):
+        self.path = path
+        self.function = function
+        self.count = 0
+        self.exceptions = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.histogram = [0]*self.BUCKETS
+
+    def record(self, elapsed, failed):
+        self.count += 1
+        self.total_time += elapsed
+        if elapsed > self.max_time:
+            self.max_time = elapsed
+        if failed:
+            self.exceptions += 1
+        bucket = min(int(elapsed*1000000).bit_length(), self.BUCKETS-1)
+        self.histogram[bucket] += 1
+
+    def mean_time(self):
+        return self.total_time/self.count if self.count else 0.0
+
+    def percentile(self, fraction):
+        # upper bound, in seconds, of the bucket the percentile falls in
+        target = self.count*fraction
+        seen = 0
+        for bucket, count in enumerate(self.histogram):
+            seen += count
+            if count and seen >= target:
+                return (2**bucket)/1000000
+        return 0.0
+
+    def name(self):
+        if self.function == None:
+            return self.path
+        return "{} {}".format(self.path, getattr(self.function, "__qualname__",
+            repr(self.function)))
+
+    def summary(self):
+        return "{}: {} calls, {} exceptions, mean {:.1f}us, p99 <{:.0f}us, max {:.1f}us".format(
+            self.name(), self.count, self.exceptions, self.mean_time()*1000000,
+            self.percentile(0.99)*1000000, self.max_time*1000000)
+
+    def __repr__(self):
+        return "<CallStats {}>".format(self.summary())
+
+class Instrumentation(object):
+    # what EventHook.call_with records into when instrumentation is switched
+    # on: each callback's calls, and for each path every call_with as a whole,
+    # event, call notifier and all. timings for coroutine and executor
+    # callbacks only cover scheduling them
+    def __init__(self):
+        self.paths = {}
+        self.callbacks = {}
+        self._lock = threading.Lock()
+
+    def record(self, hook, callback, elapsed, failed):
+        with self._lock:
+            callback_stats = self.callbacks.get(callback)
+            if callback_stats == None:
+                callback_stats = CallStats(hook.path, callback.function)
+                # forget() has been or is about to be called for it
+                if not callback.cancelled:
+                    self.callbacks[callback] = callback_stats
+            callback_stats.record(elapsed, failed)
+
+    def forget(self, callback):
+        with self._lock:
+            self.callbacks.pop(callback, None)
+
+    def record_path(self, hook, elapsed, failed):
+        # failed if any callback raised
+        with self._lock:
+            path_stats = self.paths.get(hook.path)
+            if path_stats == None:
+                path_stats = self.paths[hook.path] = CallStats(hook.path)
+            path_stats.record(elapsed, failed)
+
+    def slowest(self, n=10, by="max"):
+        # by is "max", "mean" or "total"
+        key = {"max": lambda stats: stats.max_time,
+            "mean": lambda stats: stats.mean_time(),
+            "total": lambda stats: stats.total_time}[by]
+        with self._lock:
+            return heapq.nlargest(n, self.callbacks.values(), key=key)
+
+    def busiest(self, n=10):
+        with self._lock:
+            return heapq.nlargest(n, self.paths.values(),
+                key=lambda stats: stats.total_time)
+
+    def report(self, n=10, by="max"):
+        return "\n".join(stats.summary() for stats in self.slowest(n, by))
+
+    def reset(self):
+        with self._lock:
+            self.paths.clear()
+            self.callbacks.clear()
@@ -0,0 +1,185 @@
+import atexit, logging, os, queue, threading, time
+
+LOG_LEVELS = {
+    "trace": logging.DEBUG-1,
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "warn": logging.WARN,
+    "error": logging.ERROR,
+    "critical": logging.CRITICAL
+}
+
+class Log(object):
+    # what log_message writes to. records below level are dropped before
+    # anything is formatted, the rest go on the manager's queue as they are
+    def __init__(self, manager, name, level):
+        self.manager = manager
+        self.name = name
+        self.level = level
+        self.path = os.path.join(manager.directory, "{}.log".format(name))
+        self._file = None
+        self._opened = None
+        self._size = 0
+
+    def is_enabled_for(self, level):
+        return level >= self.level
+
+    def log(self, level, message):
+        if level < self.level:
+            return
+        try:
+            self.manager.queue.put_nowait((self, time.time(), level, message))
+        except queue.Full:
+            # never hold the epoll thread up for the disk
+            self.manager.dropped += 1
+
+    def _open(self):
+        self._file = open(self.path, "a", encoding="utf8",
+            errors="backslashreplace")
+        self._opened = time.time()
+        self._size = self._file.tell()
+
+    def _write(self, text):
+        if self._file == None:
+            self._open()
+        self._file.write(text)
+        self._size += len(text)
+
+    def _should_rotate(self):
+        manager = self.manager
+        return (not manager.max_bytes == None and
+            self._size >= manager.max_bytes) or (
+            not manager.rotate_interval == None and
+            time.time()-self._opened >= manager.rotate_interval)
+
+    def _rotate(self):
+        # name.log -> name.log.1 -> ... -> name.log.<backups>
+        self._file.close()
+        self._file = None
+        backups = self.manager.backups
+        for i in range(backups-1, 0, -1):
+            source = "{}.{}".format(self.path, i)
+            if os.path.exists(source):
+                os.replace(source, "{}.{}".format(self.path, i+1))
+        if backups:
+            os.replace(self.path, "{}.1".format(self.path))
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def _close(self):
+        if not self._file == None:
+            self._file.close()
+            self._file = None
+
+    def __repr__(self):
+        return "<Log {} ({})>".format(self.name, logging.getLevelName(
+            self.level))
+
+class LogManager(object):
+    # one background thread writes every log, taking records off a bounded
+    # queue a batch at a time and formatting them as
+    # "2000-01-01 00:00:00,000 INFO message" like logging.Formatter did
+    def __init__(self, directory="logs", level=logging.INFO,
+            max_bytes=10*1024*1024, rotate_interval=None, backups=5,
+            queue_size=65536, batch_size=1024):
+        self.directory = directory
+        self.level = level
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backups = backups
+        self.batch_size = batch_size
+        self.queue = queue.Queue(queue_size)
+        self.logs = {}
+        self.dropped = 0
+        self.written = 0
+        self._lock = threading.Lock()
+        self._timestamp_second = None
+        self._timestamp = None
+        self._running = False
+        self._thread = None
+
+    def get(self, name):
+        log = self.logs.get(name)
+        if log == None:
+            with self._lock:
+                log = self.logs.get(name)
+                if log == None:
+                    log = self.logs[name] = Log(self, name, self.level)
+        return log
+
+    def start(self):
+        if self._running:
+            return
+        with self._lock:
+            if self._running:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self._running = True
+            self._thread = threading.Thread(target=self._run,
+                name="LogManager")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        # writes out whatever is still queued, then closes every log
+        if not self._running:
+            return
+        self._running = False
+        self.queue.put((None, None, None, None))
+        self._thread.join(timeout)
+
+    def _format_time(self, timestamp):
+        second = int(timestamp)
+        if not second == self._timestamp_second:
+            self._timestamp_second = second
+            self._timestamp = time.strftime("%Y-%m-%d %H:%M:%S",
+                time.localtime(second))
+        return "{},{:03d}".format(self._timestamp, int(timestamp%1*1000))
+
+    def _run(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            texts = {}
+            for log, timestamp, level, message in batch:
+                if log == None:
+                    running = False
+                    continue
+                texts.setdefault(log, []).append("{} {} {}\n".format(
+                    self._format_time(timestamp), logging.getLevelName(level),
+                    message))
+            for log, lines in texts.items():
+                try:
+                    log._write("".join(lines))
+                    log._file.flush()
+                    if log._should_rotate():
+                        log._rotate()
+                except OSError:
+                    self.dropped += len(lines)
+                    log._close()
+                else:
+                    self.written += len(lines)
+        for log in list(self.logs.values()):
+            log._close()
+
+    def stats(self):
+        return {"queued": self.queue.qsize(), "written": self.written,
+            "dropped": self.dropped}
+
+# written out by a background thread, so logging never waits on the disk
+log_manager = LogManager("logs")
+atexit.register(log_manager.stop)
+
+def get_logger(name):
+    log_manager.start()
+    return log_manager.get(name)
+
+def log_message(name, message, level="info"):
+    get_logger(name).log(LOG_LEVELS[level], message)
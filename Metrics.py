@@ -0,0 +1,214 @@
+import bisect, http.server, os, threading, time
+
+from Logs import log_message
+
+# upper bounds of histogram buckets, as Prometheus' "le"
+READ_BURST_BUCKETS = [64, 256, 1024, 4096, 16384, 65536]
+PING_RTT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+DISPATCH_BUCKETS = [0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01,
+    0.05, 0.1]
+
+class Histogram(object):
+    __slots__ = ["bounds", "counts", "sum", "count"]
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # the last is everything above the last bound
+        self.counts = [0]*(len(bounds)+1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def add(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+        self.count += other.count
+
+class ConnectionMetrics(object):
+    # kept by each Bot on the epoll thread, so just attributes to increment
+    __slots__ = ["bytes_in", "bytes_out", "lines_in", "lines_out",
+        "read_bursts", "ping_rtt", "last_ping_rtt", "dispatch"]
+    COUNTERS = ["bytes_in", "bytes_out", "lines_in", "lines_out"]
+    HISTOGRAMS = ["read_bursts", "ping_rtt", "dispatch"]
+
+    def __init__(self):
+        self.bytes_in = self.bytes_out = 0
+        self.lines_in = self.lines_out = 0
+        # bytes per recv
+        self.read_bursts = Histogram(READ_BURST_BUCKETS)
+        # seconds from sending a PING to its PONG
+        self.ping_rtt = Histogram(PING_RTT_BUCKETS)
+        self.last_ping_rtt = None
+        # seconds IRCLineHandler.handle took per line
+        self.dispatch = Histogram(DISPATCH_BUCKETS)
+
+    def add(self, other):
+        for name in self.COUNTERS:
+            setattr(self, name, getattr(self, name)+getattr(other, name))
+        for name in self.HISTOGRAMS:
+            getattr(self, name).add(getattr(other, name))
+
+    def summary(self):
+        return {"bytes_in": self.bytes_in, "bytes_out": self.bytes_out,
+            "lines_in": self.lines_in, "lines_out": self.lines_out,
+            "read_burst_mean": self.read_bursts.sum/self.read_bursts.count
+                if self.read_bursts.count else None,
+            "ping_rtt_mean": self.ping_rtt.sum/self.ping_rtt.count
+                if self.ping_rtt.count else None,
+            "dispatch_mean": self.dispatch.sum/self.dispatch.count
+                if self.dispatch.count else None}
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace(
+        "\"", "\\\"")
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{{{}}}".format(",".join("{}=\"{}\"".format(key, _escape(value))
+        for key, value in labels))
+
+def _histogram_lines(name, histogram):
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.bounds+["+Inf"], histogram.counts):
+        cumulative += count
+        lines.append("{}_bucket{{le=\"{}\"}} {}".format(name, bound,
+            cumulative))
+    lines.append("{}_sum {}".format(name, histogram.sum))
+    lines.append("{}_count {}".format(name, histogram.count))
+    return lines
+
+def total_metrics(bot_manager):
+    # cumulative totals across every bot there has been
+    total = ConnectionMetrics()
+    total.add(bot_manager.retired_metrics)
+    for bot in list(bot_manager.bots.values()):
+        total.add(bot.metrics)
+    return total
+
+def render(bot_manager, prefix="cobaltlongclaw"):
+    # the Prometheus text format: cumulative totals across every connection
+    # there has been, and counters and gauges per live connection
+    bots = list(bot_manager.bots.values())
+    total = total_metrics(bot_manager)
+
+    lines = []
+    def metric(name, kind, description, samples):
+        name = "{}_{}".format(prefix, name)
+        lines.append("# HELP {} {}".format(name, description))
+        lines.append("# TYPE {} {}".format(name, kind))
+        for labels, value in samples:
+            lines.append("{}{} {}".format(name, _labels(labels), value))
+    def connection_labels(bot):
+        return [("connection", bot.connection_id), ("nickname", bot.nickname)]
+
+    metric("connections", "gauge", "Connected bots.", [(None, len(bots))])
+    for name, description in [
+            ("bytes_in", "Bytes received."), ("bytes_out", "Bytes sent."),
+            ("lines_in", "Lines received."),
+            ("lines_out", "Lines queued to send.")]:
+        metric("{}_total".format(name), "counter", description,
+            [(None, getattr(total, name))])
+        metric("connection_{}_total".format(name), "counter", description,
+            [(connection_labels(bot), getattr(bot.metrics, name))
+            for bot in bots])
+    metric("write_queue_bytes", "gauge", "Bytes waiting to be sent.",
+        [(None, sum(bot.queued_bytes for bot in bots))])
+    metric("connection_write_queue_bytes", "gauge",
+        "Bytes waiting to be sent.",
+        [(connection_labels(bot), bot.queued_bytes) for bot in bots])
+    metric("connection_ping_rtt_seconds", "gauge",
+        "Time from the last answered PING to its PONG.",
+        [(connection_labels(bot), bot.metrics.last_ping_rtt) for bot in bots
+        if not bot.metrics.last_ping_rtt == None])
+    metric("connection_dispatch_seconds_total", "counter",
+        "Time spent handling received lines.",
+        [(connection_labels(bot), bot.metrics.dispatch.sum) for bot in bots])
+
+    for name, histogram, description in [
+            ("read_burst_bytes", total.read_bursts, "Bytes per read."),
+            ("ping_rtt_seconds", total.ping_rtt,
+                "Time from sending a PING to its PONG."),
+            ("dispatch_seconds", total.dispatch,
+                "Time spent handling each received line.")]:
+        name = "{}_{}".format(prefix, name)
+        lines.append("# HELP {} {}".format(name, description))
+        lines.append("# TYPE {} histogram".format(name))
+        lines.extend(_histogram_lines(name, histogram))
+    return "\n".join(lines)+"\n"
+
+def write_textfile(bot_manager, path):
+    # for node_exporter's textfile collector, which mustn't see it half
+    # written
+    temporary_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary_path, "w") as f:
+        f.write(render(bot_manager))
+    os.replace(temporary_path, path)
+
+class MetricsExporter(object):
+    # writes a textfile every interval seconds and/or serves /metrics on
+    # 127.0.0.1:port, each from its own thread
+    def __init__(self, bot_manager, textfile=None, port=None, interval=15,
+            host="127.0.0.1"):
+        self.bot_manager = bot_manager
+        self.textfile = textfile
+        self.port = port
+        self.host = host
+        self.interval = interval
+        self.running = False
+        self._httpd = None
+
+    def start(self):
+        self.running = True
+        if not self.textfile == None:
+            thread = threading.Thread(target=self._write_loop,
+                name="MetricsExporter")
+            thread.daemon = True
+            thread.start()
+        if not self.port == None:
+            exporter = self
+            class Handler(http.server.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if not self.path == "/metrics":
+                        self.send_error(404)
+                        return
+                    body = render(exporter.bot_manager).encode("utf8")
+                    self.send_response(200)
+                    self.send_header("Content-Type",
+                        "text/plain; version=0.0.4; charset=utf-8")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                def log_message(self, format, *args):
+                    pass
+            self._httpd = http.server.ThreadingHTTPServer(
+                (self.host, self.port), Handler)
+            self.port = self._httpd.server_address[1]
+            thread = threading.Thread(target=self._httpd.serve_forever,
+                name="MetricsHTTP")
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def _write_loop(self):
+        while self.running:
+            # e.g. the directory's gone or the disk is full, which may not
+            # last, so keep trying
+            try:
+                write_textfile(self.bot_manager, self.textfile)
+            except OSError as e:
+                log_message("metrics", "Failed to write {}: {}".format(
+                    self.textfile, e), "error")
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        if not self._httpd == None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
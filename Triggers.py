@@ -0,0 +1,128 @@
+import re
+
+INLINE_FLAGS = ((re.IGNORECASE, "i"), (re.MULTILINE, "m"), (re.DOTALL, "s"),
+    (re.VERBOSE, "x"))
+# numbered backreferences would point at the wrong group once combined
+RE_BACKREFERENCE = re.compile(r"\\[1-9]")
+
+class Trigger(object):
+    def __init__(self, engine, pattern, function, order):
+        self.engine = engine
+        self.pattern = pattern
+        self.function = function
+        self.order = order
+        self.cancelled = False
+    def unhook(self):
+        if not self.cancelled:
+            self.cancelled = True
+            self.engine._remove(self)
+
+class TriggerEngine(object):
+    # tests a message against every trigger at once. a string trigger is a
+    # command word, e.g. "!cmd", looked up by the message's first word. all
+    # the compiled regex triggers are joined into one alternation, which is
+    # searched first: most messages match no trigger at all, and one search
+    # of the alternation costs about as much as a single pattern does. only
+    # when it finds something is each regex searched for on its own. each
+    # matching trigger is called as function(event, match), where match is
+    # the rest of the message for a string trigger or the re.Match for a regex
+    def __init__(self, field="message", event_hook=None):
+        self.field = field
+        # where exceptions from trigger functions are reported, each as its
+        # own callback
+        self.event_hook = event_hook
+        self._commands = {}
+        self._regex_triggers = []
+        # (the combined regex, the triggers in it, regex triggers that
+        # couldn't be combined, e.g. for reusing a group name another trigger
+        # has or using backreferences), replaced as a whole by _compile so
+        # match() on another thread never sees half of it
+        self._compiled = (None, [], [])
+        self._order = 0
+
+    def add(self, pattern, function):
+        self._order += 1
+        trigger = Trigger(self, pattern, function, self._order)
+        if isinstance(pattern, str):
+            # lists are replaced rather than appended to, for match()
+            key = pattern.lower()
+            self._commands[key] = self._commands.get(key, [])+[trigger]
+        else:
+            self._regex_triggers.append(trigger)
+            self._compile()
+        return trigger
+
+    def _remove(self, trigger):
+        if not self.event_hook == None:
+            self.event_hook.get_error_reporter().forget(trigger)
+        if isinstance(trigger.pattern, str):
+            key = trigger.pattern.lower()
+            triggers = [other for other in self._commands[key]
+                if not other is trigger]
+            if triggers:
+                self._commands[key] = triggers
+            else:
+                del self._commands[key]
+        else:
+            self._regex_triggers.remove(trigger)
+            self._compile()
+
+    def _compile(self):
+        alternatives = []
+        combined_triggers = []
+        separate_triggers = []
+        for trigger in self._regex_triggers:
+            flags = "".join(c for flag, c in INLINE_FLAGS
+                if trigger.pattern.flags & flag)
+            alternative = "(?{}:{})".format(flags, trigger.pattern.pattern)
+            if RE_BACKREFERENCE.search(trigger.pattern.pattern):
+                separate_triggers.append(trigger)
+                continue
+            try:
+                re.compile("|".join(alternatives+[alternative]))
+            except re.error:
+                separate_triggers.append(trigger)
+            else:
+                alternatives.append(alternative)
+                combined_triggers.append(trigger)
+        combined = re.compile("|".join(alternatives)) if alternatives else None
+        self._compiled = (combined, combined_triggers, separate_triggers)
+
+    def match(self, message):
+        matches = []
+        command, _, rest = message.partition(" ")
+        for trigger in self._commands.get(command.lower(), []):
+            matches.append((trigger, rest))
+        combined, combined_triggers, separate_triggers = self._compiled
+        if combined and combined.search(message):
+            for trigger in combined_triggers:
+                match = trigger.pattern.search(message)
+                if match:
+                    matches.append((trigger, match))
+        for trigger in separate_triggers:
+            match = trigger.pattern.search(message)
+            if match:
+                matches.append((trigger, match))
+        if len(matches) > 1:
+            matches.sort(key=lambda match: match[0].order)
+        return matches
+
+    def __len__(self):
+        return sum(len(triggers) for triggers in self._commands.values()
+            )+len(self._regex_triggers)
+
+    def dispatch(self, event):
+        message = event.get(self.field)
+        if not message:
+            return
+        for trigger, match in self.match(message):
+            if trigger.cancelled:
+                continue
+            if self.event_hook == None:
+                trigger.function(event, match)
+                continue
+            # so one trigger raising doesn't stop the rest
+            try:
+                trigger.function(event, match)
+            except Exception as e:
+                self.event_hook._report_error(trigger, e)
@@ -1,14 +1,42 @@
+import functools, re, sys
+
+HOSTMASK_CACHE_SIZE = 4096
+
+# bold, italics, underline, strikethrough, monospace, reverse and reset
+FORMATTING_TABLE = str.maketrans("", "", "\x02\x1d\x1f\x1e\x11\x16\x0f")
+RE_COLOURS = re.compile(
+    r"\x03(?:\d{1,2}(?:,\d{1,2})?)?|\x04(?:[0-9a-fA-F]{6}(?:,[0-9a-fA-F]{6})?)?")
+
+def strip_formatting(s):
+    if "\x03" in s or "\x04" in s:
+        s = RE_COLOURS.sub("", s)
+    return s.translate(FORMATTING_TABLE)
+
 def remove_colon(s):
     if s.startswith(":"):
         s = s[1:]
     return s
 
-def separate_hostmask(hostmask):
+def _separate_hostmask(hostmask):
     hostmask = remove_colon(hostmask)
     first_delim = hostmask.find("!")
     second_delim = hostmask.find("@")
     nickname = username = hostname = hostmask
     if first_delim > -1 and second_delim > first_delim:
-        nickname, username = hostmask.split("!", 1)
-        username, hostname = hostmask.split("@", 1)
-    return nickname, username, hostname
+        nickname = hostmask[:first_delim]
+        username = hostmask[first_delim+1:second_delim]
+        hostname = hostmask[second_delim+1:]
+    # the same few thousand users' nicknames come up over and over, so
+    # share them (and let them compare by identity)
+    return sys.intern(nickname), sys.intern(username), sys.intern(hostname)
+
+separate_hostmask = functools.lru_cache(HOSTMASK_CACHE_SIZE)(
+    _separate_hostmask)
+
+def set_hostmask_cache_size(size):
+    global separate_hostmask
+    separate_hostmask = functools.lru_cache(size)(_separate_hostmask)
+
+def hostmask_cache_info():
+    # hits, misses, maxsize and currsize
+    return separate_hostmask.cache_info()
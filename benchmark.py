@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+
+import argparse, json, logging, random, sys, time, timeit, tracemalloc
+
+from Bot import Bot
+from BotManager import BotManager
+import EventManager, IRCLine, IRCLineHandler, Logs, Utils
+
+SAMPLE_LINES = [
+    ":nick!user@host.example.com PRIVMSG #channel :hello there, how is everyone doing today?",
+    ":nick!user@host.example.com PRIVMSG #channel :\x01ACTION waves\x01",
+    ":other!~ident@1.2.3.4 JOIN :#channel",
+    ":other!~ident@1.2.3.4 PART #channel :leaving",
+    ":irc.example.com 353 me = #channel :me @op +voice nick other another yetanother",
+    ":irc.example.com 005 me CHANTYPES=# PREFIX=(ov)@+ CASEMAPPING=rfc1459 :are supported by this server",
+    ":irc.example.com 372 me :- a line of the message of the day, which is fairly long and tells you things",
+    "PING :irc.example.com",
+    "@time=2020-01-01T00:00:00.000Z;account=nick :nick!user@host PRIVMSG #channel :tagged message",
+]
+
+# BotManager.parse_line's tokenising, as it was before IRCLine
+def legacy_parse(line):
+    prefix, final = None, None
+    if line[0] == ":":
+        prefix, line = line[1:].split(" ", 1)
+    command, line = (line.split(" ", 1) + [""])[:2]
+    if line[0] == ":":
+        final, line = line[1:], ""
+    elif " :" in line:
+        line, final = line.split(" :", 1)
+    args_split = line.split(" ") if line else []
+    if final:
+        args_split.append(final)
+    return prefix, command, args_split, final!=None
+
+WORDS = ["hello", "there", "the", "quick", "brown", "fox", "jumps", "over",
+    "lazy", "dog", "anyone", "seen", "this", "build", "is", "broken", "again",
+    "lol", "yes", "no", "maybe", "tomorrow", "https://example.com/a/page"]
+
+def synthetic_corpus(count=10000, seed=0):
+    # roughly what a bot in a few busy channels sees: mostly PRIVMSGs, some
+    # joins, parts and quits, numerics with long NAMES and MOTD lines, pings
+    # and the odd tagged line
+    rng = random.Random(seed)
+    nicknames = ["nick{}".format(i) for i in range(200)]
+    channels = ["#channel{}".format(i) for i in range(5)]
+    def hostmask():
+        nickname = rng.choice(nicknames)
+        return "{}!~{}@host-{}.example.com".format(nickname, nickname,
+            rng.randint(1, 50))
+    def text(low, high):
+        return " ".join(rng.choice(WORDS) for i in range(rng.randint(low,
+            high)))
+    kinds = [
+        (55, lambda: ":{} PRIVMSG {} :{}".format(hostmask(),
+            rng.choice(channels), text(1, 20))),
+        (5, lambda: ":{} PRIVMSG {} :{}".format(hostmask(),
+            rng.choice(channels), text(60, 80))),
+        (3, lambda: ":{} PRIVMSG {} :\x01ACTION {}\x01".format(hostmask(),
+            rng.choice(channels), text(1, 6))),
+        (3, lambda: ":{} NOTICE me :{}".format(hostmask(), text(2, 10))),
+        (8, lambda: ":{} JOIN {}".format(hostmask(), rng.choice(channels))),
+        (5, lambda: ":{} PART {} :{}".format(hostmask(), rng.choice(channels),
+            text(0, 3))),
+        (3, lambda: ":{} QUIT :Quit: {}".format(hostmask(), text(0, 3))),
+        (2, lambda: ":{} NICK :{}".format(hostmask(), rng.choice(nicknames))),
+        (4, lambda: ":irc.example.com 353 me = {} :{}".format(
+            rng.choice(channels), " ".join(rng.choice(["", "@", "+"])+nickname
+            for nickname in rng.sample(nicknames, 50)))),
+        (3, lambda: ":irc.example.com 352 me {} ~{} host.example.com "
+            "irc.example.com {} H@ :0 {}".format(rng.choice(channels),
+            rng.choice(nicknames), rng.choice(nicknames), text(1, 3))),
+        (4, lambda: ":irc.example.com 372 me :- {}".format(text(5, 15))),
+        (3, lambda: "PING :irc.example.com"),
+        (2, lambda: "@time=2020-01-01T00:00:00.000Z;account={} :{} PRIVMSG "
+            "{} :{}".format(rng.choice(nicknames), hostmask(),
+            rng.choice(channels), text(1, 20))),
+        ]
+    weights = [weight for weight, generate in kinds]
+    generators = [generate for weight, generate in kinds]
+    lines = [":irc.example.com 001 me :Welcome to the network",
+        ":irc.example.com 005 me CHANTYPES=# PREFIX=(ov)@+ "
+        "CASEMAPPING=rfc1459 :are supported by this server"]
+    lines += [":me!~me@bot.example.com JOIN {}".format(channel)
+        for channel in channels]
+    while len(lines) < count:
+        lines.append(rng.choices(generators, weights)[0]())
+    return lines
+
+class BenchmarkSocket(object):
+    # gives read() the same chunk of traffic every time and swallows writes
+    def __init__(self, data=b""):
+        self.data = data
+    def fileno(self):
+        return -1
+    def recv_into(self, view):
+        length = min(len(view), len(self.data))
+        view[:length] = self.data[:length]
+        return length
+    def send(self, data):
+        return len(data)
+    def sendmsg(self, buffers):
+        return sum(len(buffer) for buffer in buffers)
+    def close(self):
+        pass
+
+def new_bot():
+    return Bot(BenchmarkSocket(), "me", "me", "me")
+
+def new_bot_manager(hook_count):
+    # hook_count do-nothing hooks spread over the events bots usually hook
+    bot_manager = BotManager()
+    paths = ["received/message/channel", "received/message/private",
+        "received/join", "received/part", "received/quit", "received/nick",
+        "received/notice/private", "received/numeric/353",
+        "received/numeric/372", "received/ctcp/version"]
+    for i in range(hook_count):
+        bot_manager.events.single(paths[i%len(paths)]).hook(lambda event: None)
+    return bot_manager
+
+def lines_per_second(function, lines, iterations):
+    timer = timeit.Timer(lambda: [function(line) for line in lines])
+    best = min(timer.repeat(5, iterations))
+    return (len(lines)*iterations)/best
+
+def interleaved_lines_per_second(functions, lines, iterations, repeat=25):
+    # times each of functions in turn, repeat times over, so a slow patch of
+    # the machine can't land on just one of them
+    timers = [(name, timeit.Timer(lambda function=function: [function(line)
+        for line in lines])) for name, function in functions]
+    best = {}
+    for i in range(repeat):
+        for name, timer in timers:
+            duration = timer.timeit(iterations)
+            best[name] = min(best.get(name, duration), duration)
+    return {name: (len(lines)*iterations)/best[name] for name, timer in timers}
+
+def parser_benchmarks(iterations):
+    # the legacy parser can't cope with tags. everything it returns is a
+    # plain attribute of IRCLine, so the two are timed as they are
+    plain_lines = [line for line in SAMPLE_LINES if not line.startswith("@")]
+    results = interleaved_lines_per_second([("legacy_parse", legacy_parse),
+        ("irc_line_parse", IRCLine.parse)], plain_lines, iterations//5)
+    results["irc_line_parse_tagged"] = lines_per_second(IRCLine.parse,
+        SAMPLE_LINES, iterations)
+    return results
+
+def peak_bytes_per_item(function, items, sample=500):
+    # the most memory handling one item takes at once, averaged over a
+    # sample of them. tracemalloc can't count allocations that are freed
+    # again, so this stands in for "allocations per line"
+    items = items[:sample]
+    tracemalloc.start()
+    total = 0
+    for item in items:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        function(item)
+        total += tracemalloc.get_traced_memory()[1]-current
+    tracemalloc.stop()
+    return total/len(items)
+
+def measure(function, items, iterations):
+    return {"lines_per_second": lines_per_second(function, items, iterations),
+        "peak_bytes_per_line": peak_bytes_per_item(function, items)}
+
+def parse_line_benchmark(corpus, iterations, hook_count):
+    bot_manager = new_bot_manager(hook_count)
+    bot = new_bot()
+    def parse_line(line):
+        bot_manager.parse_line(line, bot)
+        bot.send()
+    return measure(parse_line, corpus, iterations)
+
+def handle_benchmark(corpus, iterations, hook_count):
+    bot_manager = new_bot_manager(hook_count)
+    bot = new_bot()
+    def handle(line):
+        IRCLineHandler.handle(IRCLine.parse(line), bot, bot_manager)
+        bot.send()
+    return measure(handle, corpus, iterations)
+
+def fan_out_benchmark(hook_count, iterations):
+    hook = EventManager.EventHook(None).single("received/message/channel")
+    for i in range(hook_count):
+        hook.hook(lambda event: None)
+    return measure(lambda line: hook.call(message=line), ["hello"]*100,
+        iterations)
+
+def read_benchmark(corpus, iterations):
+    data = "".join(line+"\r\n" for line in corpus).encode("utf8")
+    bot = new_bot()
+    # each read() gets the same 64KiB of traffic, a partial line included
+    bot.socket.data = data[:65536]
+    lines = len(data[:65536].split(b"\n"))-1
+    result = measure(lambda n: bot.read(), [None]*10, iterations)
+    result["lines_per_second"] *= lines
+    result["peak_bytes_per_line"] /= lines
+    return result
+
+def send_benchmark(corpus, iterations):
+    bot = new_bot()
+    def queue_send(line):
+        bot.queue_send(line)
+        if bot.queued_bytes > 65536:
+            bot.send()
+    return measure(queue_send, corpus, iterations)
+
+def unhooked_benchmark(iterations):
+    # MOTD lines with nothing hooked anywhere, not even BotManager's
+    # received/numeric hook, should never get as far as building an Event
+    bot_manager = BotManager()
+    for callback in bot_manager.events.single("received/numeric").get_hooks():
+        callback.unhook()
+    bot = new_bot()
+    lines = [":irc.example.com 372 me :- line {} of the MOTD".format(i)
+        for i in range(100)]
+    built = [0]
+    class CountingEvent(EventManager.Event):
+        def __init__(self, *args, **kwargs):
+            built[0] += 1
+            EventManager.Event.__init__(self, *args, **kwargs)
+    def handle(line):
+        IRCLineHandler.handle(IRCLine.parse(line), bot, bot_manager)
+    result = measure(handle, lines, iterations)
+    Event, EventManager.Event = EventManager.Event, CountingEvent
+    try:
+        for line in lines:
+            handle(line)
+    finally:
+        EventManager.Event = Event
+    result["events_per_line"] = built[0]/len(lines)
+    return result
+
+def hostmask_benchmark(corpus, iterations):
+    prefixes = [IRCLine.parse(line).prefix for line in corpus]
+    prefixes = [prefix for prefix in prefixes if prefix and "!" in prefix]
+    return measure(Utils.separate_hostmask, prefixes, iterations)
+
+def all_benchmarks(iterations, corpus_size, hook_count):
+    # iterations are passes over the corpus, which is 10000 lines by default
+    corpus = synthetic_corpus(corpus_size)
+    results = {name: {"lines_per_second": result}
+        for name, result in parser_benchmarks(iterations*100).items()}
+    results["parse_line"] = parse_line_benchmark(corpus, iterations,
+        hook_count)
+    results["handle"] = handle_benchmark(corpus, iterations, hook_count)
+    results["handle_unhooked"] = unhooked_benchmark(iterations*100)
+    for fan_out in [1, 10, 100]:
+        results["event_call_{}_hooks".format(fan_out)] = fan_out_benchmark(
+            fan_out, iterations*10)
+    results["bot_read"] = read_benchmark(corpus, iterations*10)
+    results["bot_queue_send"] = send_benchmark(corpus, iterations)
+    results["separate_hostmask"] = hostmask_benchmark(corpus, iterations)
+    return results
+
+def compare(results, baseline, threshold):
+    # regressions are lines/s falling, or memory per line growing, by more
+    # than threshold (a fraction) compared to baseline
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get("results", {}).get(name)
+        if old == None:
+            continue
+        for metric, value in result.items():
+            old_value = old.get(metric)
+            if old_value == None:
+                continue
+            if old_value:
+                change = (value-old_value)/old_value
+            else:
+                # anything at all where there was nothing, e.g. events_per_line
+                change = threshold+1 if value > 0 else 0
+            if metric == "lines_per_second":
+                change = -change
+            if change > threshold:
+                regressions.append((name, metric, old_value, value))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--iterations", type=int, default=3,
+        help="passes over the corpus per measurement")
+    parser.add_argument("-c", "--corpus-size", type=int, default=10000,
+        help="lines of synthetic traffic")
+    parser.add_argument("-k", "--hooks", type=int, default=20,
+        help="hooks on the events parse_line and handle raise")
+    parser.add_argument("-o", "--output", help="write results here as JSON")
+    parser.add_argument("-b", "--baseline",
+        help="JSON from an earlier run to compare against")
+    parser.add_argument("-t", "--threshold", type=float, default=0.1,
+        help="how much worse than the baseline counts as a regression")
+    args = parser.parse_args()
+
+    # raw logging goes on a queue either way, this keeps it off the disk
+    Logs.log_manager.level = logging.WARN
+
+    results = all_benchmarks(args.iterations, args.corpus_size, args.hooks)
+    for name, result in results.items():
+        line = "{:<24} {:>12,.0f} lines/s".format(name,
+            result["lines_per_second"])
+        if "peak_bytes_per_line" in result:
+            line += " {:>10,.0f} bytes/line".format(
+                result["peak_bytes_per_line"])
+        if "events_per_line" in result:
+            line += " {:>6.2f} events/line".format(result["events_per_line"])
+        print(line)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"time": time.time(), "python": sys.version,
+                "iterations": args.iterations, "corpus_size": args.corpus_size,
+                "hooks": args.hooks, "results": results}, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for name, metric, old_value, value in regressions:
+            print("REGRESSION {} {}: {:,.1f} -> {:,.1f}".format(name, metric,
+                old_value, value))
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import argparse, logging, socket, threading, time
+
+from Bot import Bot
+from BotManager import BotManager
+from IRCServer import IRCServer
+import Logs
+
+def percentile(values, fraction):
+    return values[min(int(len(values)*fraction), len(values)-1)]
+
+def connect_bots(bot_manager, address, count, channel):
+    # returns once every bot has joined channel
+    joined = threading.Semaphore(0)
+    bot_manager.events.single("received/numeric/001").hook(
+        lambda event: event["bot"].send_join(channel))
+    bot_manager.events.single("self/join").hook(lambda event: joined.release())
+    for i in range(count):
+        bot = Bot(socket.create_connection(address), "bot{}".format(i),
+            "bot", "bot")
+        bot.use_prefix = False
+        bot.identify()
+        bot_manager.add_bot(bot)
+    for i in range(count):
+        if not joined.acquire(timeout=10):
+            raise TimeoutError("only {} of {} bots joined".format(i, count))
+
+def load_test(bot_count=10, rate=1000.0, count=10000, users=10, length=50,
+        latency=0.0, channel="#load"):
+    # every bot is sent every message the generated users say in channel, so
+    # bot_count*count messages are delivered
+    server = IRCServer(latency=latency)
+    address = server.start()
+    bot_manager = BotManager()
+    bot_manager.start()
+
+    latencies = []
+    done = threading.Event()
+    expected = bot_count*count
+    def on_message(event):
+        sent = float(event["message"].split(" ", 1)[0])
+        latencies.append(time.monotonic()-sent)
+        if len(latencies) >= expected:
+            done.set()
+
+    try:
+        connect_bots(bot_manager, address, bot_count, channel)
+        bot_manager.events.single("received/message/channel").hook(on_message)
+
+        cpu_start, wall_start = time.process_time(), time.monotonic()
+        server.generate(channel, rate, count, users, length).result()
+        done.wait(max(10, latency*10))
+        cpu, wall = time.process_time()-cpu_start, time.monotonic()-wall_start
+    finally:
+        bot_manager.running = False
+        server.stop()
+
+    latencies.sort()
+    delivered = len(latencies)
+    return {"delivered": delivered, "expected": expected,
+        "messages_per_second": delivered/wall,
+        # the server and the generator share this process, so this is an
+        # upper bound on what the bots spend
+        "cpu_us_per_message": cpu/max(delivered, 1)*1000000,
+        "latency_p50_ms": percentile(latencies, 0.5)*1000 if latencies else None,
+        "latency_p99_ms": percentile(latencies, 0.99)*1000 if latencies else None,
+        "latency_max_ms": latencies[-1]*1000 if latencies else None}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--bot-count", type=int, default=10,
+        help="bots to connect")
+    parser.add_argument("-r", "--rate", type=float, default=1000,
+        help="messages a second said in the channel")
+    parser.add_argument("-c", "--count", type=int, default=10000,
+        help="messages to say in total")
+    parser.add_argument("-u", "--users", type=int, default=10,
+        help="generated users saying them")
+    parser.add_argument("-s", "--length", type=int, default=50,
+        help="characters per message")
+    parser.add_argument("-l", "--latency", type=float, default=0.0,
+        help="seconds the server holds back every line it sends")
+    parser.add_argument("--log", action="store_true",
+        help="write logs/raw.log as normal")
+    args = parser.parse_args()
+
+    if not args.log:
+        Logs.log_manager.level = logging.WARN
+
+    results = load_test(args.bot_count, args.rate, args.count, args.users,
+        args.length, args.latency)
+    for name, value in results.items():
+        print("{:<22} {}".format(name, "-" if value == None else
+            "{:,.2f}".format(value)))
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import argparse, time
+
+from Bot import Bot
+from BotManager import BotManager
+import Capture, IRCLine, IRCLineHandler
+
+class ReplaySocket(object):
+    # stands in for a replayed bot's socket, throwing away what it sends
+    def __init__(self, connection_id):
+        self.connection_id = connection_id
+        self.sent_bytes = 0
+    def fileno(self):
+        return self.connection_id
+    def send(self, data):
+        self.sent_bytes += len(data)
+        return len(data)
+    def sendmsg(self, buffers):
+        return self.send(b"".join(buffers))
+    def close(self):
+        pass
+
+def replay(bot_manager, records, speed=None, handle_only=False):
+    # feeds a capture's inbound lines to bot_manager, each connection as its
+    # own bot. speed 1.0 keeps the recorded timing, 2.0 is twice as fast and
+    # None is as fast as possible. handle_only skips parse_line's raw logging
+    # and goes straight to IRCLineHandler.handle
+    bots = {}
+    lines = 0
+    start = time.monotonic()
+    for record in records:
+        if not record.direction == Capture.INBOUND:
+            continue
+        bot = bots.get(record.connection_id)
+        if bot == None:
+            bot = Bot(ReplaySocket(record.connection_id), "*", "*", "*")
+            bot.connection_id = record.connection_id
+            # not add_bot(), there's nothing to poll
+            bots[record.connection_id] = bot_manager.bots[
+                record.connection_id] = bot
+        if speed:
+            delay = record.timestamp/speed-(time.monotonic()-start)
+            if delay > 0:
+                time.sleep(delay)
+        if handle_only:
+            IRCLineHandler.handle(IRCLine.parse(record.line), bot,
+                bot_manager)
+        else:
+            bot_manager.parse_line(record.line, bot)
+        while bot.waiting_send():
+            bot.send()
+        lines += 1
+    return lines, time.monotonic()-start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("capture", help="file written by BotManager.start_capture")
+    parser.add_argument("-s", "--speed", type=float, help=
+        "replay at this multiple of the recorded speed, rather than as fast as possible")
+    parser.add_argument("-H", "--handle-only", action="store_true", help=
+        "call IRCLineHandler.handle directly, skipping BotManager.parse_line")
+    args = parser.parse_args()
+
+    started, records = Capture.read_capture(args.capture)
+    print("capture started {}".format(time.strftime("%Y-%m-%d %H:%M:%S",
+        time.localtime(started))))
+    lines, duration = replay(BotManager(), records, args.speed,
+        args.handle_only)
+    print("{:,} lines in {:.2f}s, {:,.0f} lines/s".format(lines, duration,
+        lines/duration if duration else 0))
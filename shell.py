@@ -1,8 +1,7 @@
 #!/usr/bin/env python3
 
-import argparse, random, select, string, subprocess, time, threading, sys
+import argparse, random, string, subprocess, time, threading, sys
 import socket, resource
-import logging
 
 import sockschain as socks, stem, stem.control
 
@@ -12,7 +11,9 @@ from traitlets import config
 
 
 from Bot import Bot
-import EventManager, IRCLineHandler
+from BotManager import BotManager
+import EventManager, Metrics
+from Logs import LOG_LEVELS, log_manager, get_logger, log_message
 
 IRC_COLORS = ["02", "03", "04", "05", "06", "07", "08", "09",
     "10", "11", "12", "13"]
@@ -32,37 +33,6 @@ def read_proxy_list(filename):
                 proxies.add((line[0], line[2], int(line[1])))
     return proxies
 
-LOG_LEVELS = {
-    "trace": logging.DEBUG-1,
-    "debug": logging.DEBUG,
-    "info": logging.INFO,
-    "warn": logging.WARN,
-    "error": logging.ERROR,
-    "critical": logging.CRITICAL
-}
-
-loggers = {}
-
-def get_logger(name):
-    global loggers
-    if name in loggers:
-        return loggers[name]
-
-    formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
-    # This mode ensures that logs will be overwritten on each run
-    handler = logging.FileHandler("logs/{}.log".format(name), mode="w")
-    handler.setFormatter(formatter)
-
-    logger = logging.getLogger(name)
-    logger.setLevel(logging.INFO)
-    logger.addHandler(handler)
-
-    loggers[name] = logger
-    return logger
-
-def log_message(name, message, level="info"):
-    get_logger(name).log(LOG_LEVELS[level], message)
-
 def new_circuit(tor_password, tor_port):
     log_message("proxy", "Acquiring new Tor circuit")
     with stem.control.Controller.from_port(port = tor_port
@@ -110,116 +80,6 @@ class LambdaIdentityProvider(IdentityProvider):
     def __init__(identity_function):
         self.new_identity = identity_function
 
-class BotManager(object):
-    def __init__(self):
-        self.bots = {}
-        self.running = True
-        self.events = EventManager.EventHook(self)
-
-        def set_status(event):
-            event["bot"].last_status = event["command"]
-        self.events.single("received/numeric").hook(set_status)
-
-        self.poll = select.epoll()
-        self._random_nicknames = []
-
-    def run(self):
-        while self.running:
-            events = self.poll.poll(10)
-            for fileno, event in events:
-                bot = self.bots[fileno]
-                if event & select.EPOLLIN:
-                    lines = bot.read()
-                    if not lines:
-                        log_message("bots", "Removing for empty select")
-                        self.remove_bot(bot)
-                    else:
-                        for line in lines:
-                            # If this isn't None, the connection is effectively dead
-                            quit_status = self.parse_line(line, bot)
-                            if quit_status:
-                                log_message("bots", "Removing for END")
-                                self.remove_bot(bot)
-                                continue
-
-                elif event & select.EPOLLOUT:
-                    bot.send()
-                    self.poll.modify(bot.fileno(),
-                        select.EPOLLIN)
-
-                elif event & select.EPOLLHUP:
-                    log_message("bots", "Removing for hangup")
-                    self.remove_bot(bot)
-
-            for bot in list(self.bots.values()):
-                since_last_read = (
-                    None if not bot.last_read else time.time(
-                    )-bot.last_read)
-                if since_last_read:
-                    if since_last_read > 120:
-                        log_message("bots", "Removing for presumed timeout")
-                        self.remove_bot(bot)
-                        continue
-                    elif since_last_read > 30 and not bot.ping_sent:
-                        bot.send_ping()
-                if bot.waiting_send():
-                    self.poll.modify(bot.fileno(),
-                        select.EPOLLIN|select.EPOLLOUT)
-
-    def parse_line(self, line, bot):
-        if not line:
-            return
-
-        # Some telnet shells like to echo everything back.
-        # Fortunately, IRCDs will not return your prefix
-        if line.startswith(":{} ".format(bot.prefix)): return
-
-        log_message("raw", line, "info")
-
-        # Getting an END means this is a dead telnet connection,
-        # so it should be closed at the earliest opportunity
-        if line == "END":
-            return True
-
-        original_line = line
-        prefix, final = None, None
-        if line[0] == ":":
-            prefix, line = line[1:].split(" ", 1)
-        command, line = (line.split(" ", 1) + [""])[:2]
-        if line[0] == ":":
-            final, line = line[1:], ""
-        elif " :" in line:
-            line, final = line.split(" :", 1)
-        args_split = line.split(" ") if line else []
-        if final:
-            args_split.append(final)
-        IRCLineHandler.handle(original_line, prefix, command, args_split, final!=None, bot, self)
-
-    def all(self, function, *args):
-        for bot in list(self.bots.values()):
-            function(bot, *args)
-
-    def add_bot(self, bot):
-        self.bots[bot.fileno()] = bot
-        self.poll.register(bot.fileno(), select.EPOLLIN)
-
-    def remove_bot(self, bot):
-        self.poll.unregister(bot.fileno())
-        del self.bots[bot.fileno()]
-        bot.socket.close()
-
-    def __len__(self):
-        return len(self.bots)
-
-    def start(self):
-        self.thread = threading.Thread(target=self.run)
-        self.thread.daemon = True
-        self.thread.start()
-        return self.thread
-
-    def summary(self):
-        return ", ".join([a.summary() for a in self.bots.values()])
-
 class ClientFactory(object):
     def __init__(self, host, port, bot_count, tor_password,
             tor_port, proxies, use_tor=True, circuit_cycle=1, min_chain_len=1):
@@ -306,9 +166,23 @@ if __name__ == "__main__":
     parser.add_argument("-m", "--minimum-chain-length", help="Treat proxies as exhausted below this count", default=1, type=int)
     parser.add_argument("-tc", "--tor-circuit-cycle", type=int,
         help="Cycle Tor exit after n connections", default=1)
+    parser.add_argument("-ll", "--log-level", choices=LOG_LEVELS.keys(),
+        default="info", help="lowest level of message to log")
+    parser.add_argument("-ls", "--log-max-bytes", type=int,
+        default=10*1024*1024, help="rotate logs once they reach this size")
+    parser.add_argument("-lr", "--log-rotate-interval", type=int, help=
+        "rotate logs after this many seconds")
+    parser.add_argument("-mf", "--metrics-textfile", help=
+        "write Prometheus metrics to this file every 15 seconds")
+    parser.add_argument("-mp", "--metrics-port", type=int, help=
+        "serve Prometheus metrics on 127.0.0.1:port/metrics")
 
     args = parser.parse_args()
 
+    log_manager.level = LOG_LEVELS[args.log_level]
+    log_manager.max_bytes = args.log_max_bytes
+    log_manager.rotate_interval = args.log_rotate_interval
+
     resource.setrlimit(resource.RLIMIT_NOFILE, (2000, 3000))
 
     proxies = []
@@ -319,6 +193,10 @@ if __name__ == "__main__":
         args.bot_count, args.tor_password, args.tor_port, proxies, args.use_tor, args.tor_circuit_cycle, args.minimum_chain_length)
 
     bot_manager = client_factory.bot_manager
+    metrics_exporter = Metrics.MetricsExporter(bot_manager,
+        args.metrics_textfile, args.metrics_port)
+    if args.metrics_textfile or not args.metrics_port == None:
+        metrics_exporter.start()
 
     sys.argv = sys.argv[:1]
     c = config.Config()
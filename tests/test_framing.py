@@ -0,0 +1,170 @@
+import random, socket
+
+import pytest
+
+import Bot, IRCLine
+
+class ChunkSocket(object):
+    # hands out exactly the chunks it's given, one per recv_into, then
+    # raises BlockingIOError like a non-blocking socket with nothing to read
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+    def fileno(self):
+        return -1
+    def recv_into(self, view):
+        if not self.chunks:
+            if self.closed:
+                return 0
+            raise BlockingIOError()
+        chunk = self.chunks.pop(0)
+        view[:len(chunk)] = chunk[:len(view)]
+        if len(chunk) > len(view):
+            self.chunks.insert(0, chunk[len(view):])
+        return min(len(chunk), len(view))
+
+def new_bot(s):
+    return Bot.Bot(s, "nick", "user", "real")
+
+def read_all(bot):
+    lines = []
+    while True:
+        read = bot.read()
+        if not read:
+            return lines, read
+        lines.extend(read)
+
+LINES = [":nick!user@host PRIVMSG #channel :hello there",
+    ":irc.example.com 372 me :- "+"x"*400, "PING :irc.example.com", "",
+    "@time=2020-01-01T00:00:00.000Z :nick!user@host JOIN #channel",
+    ":nick!user@host PRIVMSG #channel :café"]
+
+@pytest.mark.parametrize("seed", range(20))
+def test_read_random_chunks(seed):
+    rng = random.Random(seed)
+    data = "".join(line+"\r\n" for line in LINES*20).encode("utf8")
+    s = ChunkSocket()
+    bot = new_bot(s)
+    lines = []
+    i = 0
+    while i < len(data):
+        size = rng.randint(1, 3000)
+        s.chunks.append(data[i:i+size])
+        i += size
+        lines.extend(read_all(bot)[0])
+    assert lines == LINES*20
+
+def test_read_crlf_split():
+    s = ChunkSocket()
+    bot = new_bot(s)
+    s.chunks.append(b"PING :a\r")
+    assert read_all(bot) == ([], [])
+    s.chunks.append(b"\nPING :b\r")
+    assert read_all(bot) == (["PING :a"], [])
+    s.chunks.append(b"\n")
+    assert read_all(bot) == (["PING :b"], [])
+
+def test_read_bare_lf():
+    s = ChunkSocket()
+    bot = new_bot(s)
+    s.chunks.append(b"PING :a\nPING :b\r\n\n")
+    assert read_all(bot)[0] == ["PING :a", "PING :b", ""]
+
+def test_read_latin1_fallback():
+    s = ChunkSocket()
+    bot = new_bot(s)
+    s.chunks.append(b"PRIVMSG #c :caf\xe9\r\n")
+    assert read_all(bot)[0] == ["PRIVMSG #c :café"]
+
+def test_read_compacts_partial_line():
+    s = ChunkSocket()
+    bot = new_bot(s)
+    size = len(bot._read_buffer)
+    s.chunks.append(b"a"*2000+b"\r\npar")
+    assert read_all(bot)[0] == ["a"*2000]
+    s.chunks.append(b"tial")
+    assert read_all(bot)[0] == []
+    # the next read wouldn't fit after the partial line, so it's moved to
+    # the start rather than the buffer growing
+    s.chunks.append(b"\r\n")
+    assert read_all(bot)[0] == ["partial"]
+    assert len(bot._read_buffer) == size
+    assert bot._read_start == bot._read_end
+
+def test_read_buffer_stays_bounded():
+    s = ChunkSocket()
+    bot = new_bot(s)
+    line = b":nick!user@host PRIVMSG #channel :"+b"x"*200+b"\r\n"
+    for i in range(500):
+        # always leave part of a line behind
+        s.chunks.append(line[100:]+line*30+line[:100] if i else
+            line*30+line[:100])
+        assert len(read_all(bot)[0]) == (30 if i == 0 else 31)
+    assert len(bot._read_buffer) <= Bot.READ_SIZE_MAX*2
+
+def test_read_eof_and_eagain():
+    a, b = socket.socketpair()
+    try:
+        a.setblocking(False)
+        bot = new_bot(a)
+        # nothing to read yet is [], not None
+        assert bot.read() == []
+        assert bot.read_error == None
+        b.sendall(b"PING :a\r\nPING")
+        assert bot.read() == ["PING :a"]
+        b.close()
+        # the partial line is dropped along with the connection
+        assert bot.read() == None
+        assert isinstance(bot.read_error, EOFError)
+    finally:
+        a.close()
+
+def test_read_closed_scripted():
+    s = ChunkSocket()
+    bot = new_bot(s)
+    s.chunks.append(b"PING :a\r\n")
+    s.closed = True
+    assert read_all(bot) == (["PING :a"], None)
+
+def parsed(line):
+    line = IRCLine.parse(line)
+    return line.tags, line.prefix, line.command, line.args, line.is_final
+
+def test_parse_tag_escapes():
+    tags = IRCLine.parse("@a=b\\sc\\:d\\\\e\\r\\n;f;g=;h=x\\;i=\\q "
+        ":nick!user@host PRIVMSG #channel :hi").tags
+    assert tags == {"a": "b c;d\\e\r\n", "f": "", "g": "", "h": "x",
+        "i": "q"}
+
+def test_parse_tags():
+    assert parsed("@time=2020 :nick!user@host PRIVMSG #channel :hi there"
+        ) == ({"time": "2020"}, "nick!user@host", "PRIVMSG",
+        ["#channel", "hi there"], True)
+    assert parsed("@a=b  PING  :x") == ({"a": "b"}, None, "PING", ["x"], True)
+
+def test_parse_bare_commands():
+    assert parsed("PING") == ({}, None, "PING", [], False)
+    assert parsed(":irc.example.com 001") == ({}, "irc.example.com", "001",
+        [], False)
+    assert parsed("") == ({}, None, "", [], False)
+
+def test_parse_empty_trailing():
+    assert parsed(":nick!user@host PRIVMSG #channel :") == ({},
+        "nick!user@host", "PRIVMSG", ["#channel", ""], True)
+    assert parsed("AWAY :") == ({}, None, "AWAY", [""], True)
+
+def test_parse_params():
+    assert parsed(":irc.example.com 005 me CHANTYPES=# NICKLEN=30 "
+        ":are supported by this server") == ({}, "irc.example.com", "005",
+        ["me", "CHANTYPES=#", "NICKLEN=30", "are supported by this server"],
+        True)
+    # only the first " :" starts the trailing parameter
+    assert parsed(":a  MODE  #c  +o  b :x :y") == ({}, "a", "MODE",
+        ["#c", "+o", "b", "x :y"], True)
+    assert parsed("JOIN #channel") == ({}, None, "JOIN", ["#channel"], False)
+
+def test_parse_splits_only_on_spaces():
+    assert parsed(":n!u@h JOIN #café\xa0bar")[3] == ["#café\xa0bar"]
+    assert parsed(":n!u@h PRIVMSG #a\u3000b :hi")[3] == ["#a\u3000b", "hi"]
+    assert parsed("PRIVMSG #a\x1fb\x0bc\td :hi")[3] == ["#a\x1fb\x0bc\td",
+        "hi"]
@@ -0,0 +1,60 @@
+import pytest
+
+import EventManager
+
+def new_tree(limit):
+    root = EventManager.EventHook(None)
+    root.set_replay_policy(EventManager.ReplayPolicy(max_count=10),
+        recursive=True)
+    root.set_replay_limit(limit)
+    return root
+
+def replayed(hook):
+    seen = []
+    hook.hook(lambda event: seen.append(event["n"]), replay=True)
+    return seen
+
+def test_replay_limit_zero():
+    root = new_tree(0)
+    a, b = root.single("a"), root.single("b")
+    for n in range(3):
+        a.call(n=n)
+        b.call(n=n)
+    assert root.replay_stats()["retained"] == 0
+    assert replayed(a) == []
+    assert replayed(b) == []
+
+def test_replay_limit_one():
+    root = new_tree(1)
+    a, b = root.single("a"), root.single("b")
+    a.call(n=0)
+    a.call(n=1)
+    b.call(n=2)
+    # the whole tree keeps the newest event only
+    assert root.replay_stats()["retained"] == 1
+    assert replayed(a) == []
+    assert replayed(b) == [2]
+
+def test_replay_limit_lowered():
+    root = new_tree(None)
+    a = root.single("a")
+    for n in range(5):
+        a.call(n=n)
+    root.set_replay_limit(2)
+    a.call(n=5)
+    assert replayed(a) == [4, 5]
+
+def test_replay_count_and_default():
+    root = EventManager.EventHook(None)
+    a = root.single("a")
+    a.set_replay_policy(EventManager.ReplayPolicy(max_count=2))
+    for n in range(5):
+        a.call(n=n)
+    assert replayed(a) == [3, 4]
+
+def test_replay_without_policy_warns():
+    root = EventManager.EventHook(None)
+    a = root.single("a")
+    a.call(n=0)
+    with pytest.warns(RuntimeWarning, match="no replay policy"):
+        assert replayed(a) == []